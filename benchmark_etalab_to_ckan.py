@@ -0,0 +1,474 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-to-CKAN -- Tools to help migration of data.gouv.fr to CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-to-ckan
+#
+# This file is part of Etalab-to-CKAN.
+#
+# Etalab-to-CKAN is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-to-CKAN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark etalab_to_ckan offline, importing synthetic data.gouv.fr entries into a local fake CKAN.
+
+Each import is run in its own process and working directory, and the durations of its phases are read from its report.
+Upserts overlap the generation phase, so their own duration is reported, and generation is reported without its waits
+for upserts.
+"""
+
+
+import argparse
+import BaseHTTPServer
+import datetime
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import SocketServer
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+import benchmark_title_merging_rules
+import etalab_to_ckan
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+data_files_name = (
+    'organizations-groups.txt',
+    'organizations-hierarchy.txt',
+    'producteurs-orphelins.txt',
+    )
+log = logging.getLogger(app_name)
+reported_durations_name = ('generation', 'merging', 'upserts', 'deletion')
+script_dir = os.path.dirname(os.path.abspath(__file__))
+year_re = re.compile(ur'(?<!\d)(19|20)\d\d(?!\d)')
+
+
+class FakeCkanHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Minimal stand-in of the CKAN action API (and of the Producteurs page of data.gouv.fr), kept in memory."""
+    # Send each response in one packet, to avoid the delays caused by Nagle algorithm and delayed ACKs.
+    disable_nagle_algorithm = True
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def find(self, kind, id):
+        """Return the group, organization or package (depending on kind) having the given id or name."""
+        return getattr(self.server, '{}_by_id'.format(kind)).get(id) \
+            or getattr(self.server, '{}_by_name'.format(kind)).get(id)
+
+    def list_groups(self, kind, data):
+        """List the active groups or organizations (depending on kind), like CKAN: 25 at most with all their fields."""
+        items = sorted(
+            (
+                item
+                for item in getattr(self.server, '{}_by_id'.format(kind)).itervalues()
+                if item['state'] == 'active'
+                ),
+            key = lambda item: item['name'],
+            )
+        all_fields = data.get('all_fields') in (True, u'True', u'true')
+        limit = int(data['limit']) if data.get('limit') else None
+        if all_fields:
+            limit = min(limit or 25, 25)
+        offset = int(data.get('offset') or 0)
+        items = items[offset:offset + limit] if limit is not None else items[offset:]
+        return items if all_fields else [item['name'] for item in items]
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def respond(self):
+        time.sleep(self.server.latency)
+        split_url = urlparse.urlsplit(self.path)
+        if split_url.path == '/Producteurs':
+            self.send_body(200, self.server.producteurs_html, 'text/html; charset=utf-8')
+            return
+        data = dict(
+            (key, value.decode('utf-8'))
+            for key, value in urlparse.parse_qsl(split_url.query)
+            )
+        content_length = int(self.headers.get('Content-Length') or 0)
+        if content_length:
+            data.update(json.loads(urllib.unquote(self.rfile.read(content_length))))
+        action_method = getattr(self, 'action_{}'.format(split_url.path.rsplit('/', 1)[-1]), None)
+        if action_method is None:
+            self.send_body(400, json.dumps(dict(error = dict(message = u'Unknown action'), success = False)))
+            return
+        with self.server.lock:
+            try:
+                result = action_method(data)
+            except KeyError:
+                self.send_body(404, json.dumps(dict(error = dict(message = u'Not found'), success = False)))
+                return
+            except ValueError as error:
+                self.send_body(409, json.dumps(dict(error = dict(error.args[0], __type = u'Validation Error'),
+                    success = False)))
+                return
+        self.send_body(200, json.dumps(dict(help = u'', result = result, success = True)))
+
+    def send_body(self, status, body, content_type = 'application/json;charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def store_group(self, kind, data):
+        item = self.find(kind, data.get('id') or data['name']) or dict(
+            created = u'2013-01-01T00:00:00',
+            extras = [],
+            groups = [],
+            id = unicode(uuid.uuid4()),
+            packages = [],
+            tags = [],
+            users = [],
+            )
+        item.update(data)
+        item.update(
+            approval_status = u'approved',
+            is_organization = kind == 'organization',
+            state = u'active',
+            type = kind,
+            )
+        getattr(self.server, '{}_by_id'.format(kind))[item['id']] = item
+        getattr(self.server, '{}_by_name'.format(kind))[item['name']] = item
+        return item
+
+    def store_package(self, data):
+        package = self.find('package', data.get('id') or data['name']) or dict(
+            id = unicode(uuid.uuid4()),
+            )
+        package.update(data)
+        package['groups'] = [
+            dict(id = group['id'], name = self.find('group', group['id'])['name'])
+            for group in (data.get('groups') or [])
+            ]
+        organization = self.server.organization_by_id.get(package.get('owner_org'))
+        package['organization'] = dict(id = organization['id'], name = organization['name']) \
+            if organization is not None else None
+        package['state'] = data.get('state') or u'active'
+        # Dates are returned in another format, like after the isodate validator of CKAN.
+        for resource in (package.get('resources') or []):
+            for key in ('created', 'last_modified'):
+                if resource.get(key):
+                    resource[key] = coerce_date(resource[key])
+        for key in ('temporal_coverage_from', 'temporal_coverage_to'):
+            if package.get(key):
+                package[key] = coerce_date(package[key])
+        self.server.package_by_id[package['id']] = package
+        self.server.package_by_name[package['name']] = package
+        return package
+
+    # Actions
+
+    def action_bulk_update_delete(self, data):
+        for package_id in data['datasets']:
+            package = self.server.package_by_id[package_id]
+            if package.get('owner_org') != data['org_id']:
+                raise KeyError(package_id)
+        for package_id in data['datasets']:
+            self.server.package_by_id[package_id]['state'] = u'deleted'
+
+    def action_group_create(self, data):
+        return self.store_group('group', data)
+
+    def action_group_delete(self, data):
+        self.action_group_show(data)['state'] = u'deleted'
+
+    def action_group_list(self, data):
+        return self.list_groups('group', data)
+
+    def action_group_show(self, data):
+        group = self.find('group', data['id'])
+        if group is None:
+            raise KeyError(data['id'])
+        return group
+
+    def action_organization_create(self, data):
+        return self.store_group('organization', data)
+
+    def action_organization_delete(self, data):
+        self.action_organization_show(data)['state'] = u'deleted'
+
+    def action_organization_list(self, data):
+        return self.list_groups('organization', data)
+
+    def action_organization_show(self, data):
+        organization = self.find('organization', data['id'])
+        if organization is None:
+            raise KeyError(data['id'])
+        return organization
+
+    def action_organization_update(self, data):
+        return self.store_group('organization', data)
+
+    def action_package_create(self, data):
+        # Like CKAN, refuse the name of an existing package, even a deleted one.
+        if data['name'] in self.server.package_by_name:
+            raise ValueError(dict(name = [u'That URL is already in use.']))
+        return self.store_package(data)
+
+    def action_package_delete(self, data):
+        self.action_package_show(data)['state'] = u'deleted'
+
+    def action_package_search(self, data):
+        packages = sorted(
+            (
+                package
+                for package in self.server.package_by_id.itervalues()
+                if package['state'] == 'active'
+                ),
+            key = lambda package: package['name'],
+            )
+        start = int(data.get('start') or 0)
+        return dict(count = len(packages), results = packages[start:start + int(data.get('rows') or 10)])
+
+    def action_package_show(self, data):
+        package = self.find('package', data['id'])
+        if package is None:
+            raise KeyError(data['id'])
+        return package
+
+    def action_package_update(self, data):
+        return self.store_package(data)
+
+
+class FakeCkanServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency = 0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeCkanHandler)
+        self.group_by_id = {}
+        self.group_by_name = {}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.organization_by_id = {}
+        self.organization_by_name = {}
+        self.package_by_id = {}
+        self.package_by_name = {}
+        self.producteurs_html = """<html><head><meta charset="utf-8"></head><body>
+            <div class="resultatliste_item clearfix">
+                <section class="annexe"><img src="/img/logo.png"></section>
+                <section class="detail">
+                    <h2><a href="#">Institut national de la statistique et des études économiques</a></h2>
+                    <p>Producteur de<br>données statistiques</p>
+                </section>
+            </div>
+            </body></html>"""
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+
+def coerce_date(value):
+    """Return a date in the ISO format of the datetimes returned by CKAN, or unchanged when it is not a date."""
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return unicode(datetime.datetime.strptime(value, format).isoformat())
+        except ValueError:
+            continue
+    return value
+
+
+def generate_entries(count, merged_ratio):
+    """Generate synthetic data.gouv.fr entries, some of them from services having title merging rules."""
+    # Find the sources of the services having title merging rules and the titles that they merge.
+    source_by_organization_and_service = {}
+    with open(os.path.join(script_dir, 'organizations-hierarchy.txt')) as organizations_file:
+        for line in organizations_file:
+            old_title, main_title, sub_title = line.decode('utf-8').strip().split(u';;')
+            if main_title.strip():
+                source_by_organization_and_service[(main_title.strip(), sub_title.strip() or None)] = old_title
+    merged_sources_and_titles = []
+    for organization_title, organization_title_merging_rules in sorted(
+            etalab_to_ckan.title_merging_rules.iteritems()):
+        for service_title in sorted(organization_title_merging_rules):
+            source = organization_title if service_title is None \
+                else source_by_organization_and_service.get((organization_title, service_title))
+            if source is None:
+                continue
+            titles = [
+                title
+                for title in benchmark_title_merging_rules.merged_titles
+                if etalab_to_ckan.match_title_merging_rules(organization_title, service_title, title)
+                ]
+            if titles:
+                merged_sources_and_titles.append((source, titles))
+    sources = [
+        u'Direction de l’information légale et administrative',
+        u'Institut national de la statistique et des études économiques',
+        u'Météo-France',
+        u'Ministère de la Culture et de la Communication',
+        u'Office national des forêts',
+        ]
+
+    for index in xrange(count):
+        if merged_sources_and_titles and random.random() < merged_ratio:
+            source, titles = random.choice(merged_sources_and_titles)
+            if random.random() < 0.1:
+                # Undated title, that matches no rule but may be regrouped with the dated ones.
+                title = u' '.join(year_re.sub(u'', random.choice(titles)).split())
+            else:
+                title = year_re.sub(lambda match: unicode(random.randint(2005, 2013)), random.choice(titles))
+        else:
+            source = random.choice(sources)
+            title = u' '.join(random.sample(benchmark_title_merging_rules.words, random.randint(3, 10))).capitalize()
+        year = random.randint(2005, 2013)
+        etalab_id = unicode(30000000 + index)
+        yield etalab_id, {
+            u'Date de dernière modification': u'{}-12-31'.format(year),
+            u'Date de publication': u'{}-01-01'.format(year),
+            u'Description': u' '.join(random.sample(benchmark_title_merging_rules.words, 20)).capitalize(),
+            u'Données': [
+                {
+                    u'Format': random.choice([u'csv', u'xls', u'zip']),
+                    u'Titre': u'Télécharger',
+                    u'URL': u'http://www.example.com/donnees/{}/{}.csv'.format(etalab_id, resource_index),
+                    }
+                for resource_index in range(random.randint(1, 3))
+                ],
+            u'Fréquence de mise à jour': random.choice([u'Annuelle', u'Mensuelle', u'Ponctuelle']),
+            u'Licence': {
+                u'Titre': u'Licence Ouverte/Open Licence',
+                },
+            u'Mots-clés': random.sample(benchmark_title_merging_rules.words, random.randint(1, 5)),
+            u'Période': u'du 01/01/{0} au 31/12/{0}'.format(year),
+            u'Source': source,
+            u'Titre': title,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-c', '--counts', default = '1000,10000,100000',
+        help = 'comma-separated numbers of generated entries, one import by number')
+    parser.add_argument('-j', '--jobs', default = 4, help = 'number of packages upserted concurrently', type = int)
+    parser.add_argument('-k', '--keep', action = 'store_true', help = "don't remove the working directories")
+    parser.add_argument('-l', '--latency', default = 0.0, help = 'latency (in seconds) of fake CKAN requests',
+        type = float)
+    parser.add_argument('-P', '--processes', help = 'number of processes generating packages', type = int)
+    parser.add_argument('-r', '--merged-ratio', default = 0.05,
+        help = 'ratio of generated entries that may be merged with others', type = float)
+    parser.add_argument('-s', '--seed', default = 0, help = 'seed of random generator', type = int)
+    parser.add_argument('-t', '--twice', action = 'store_true',
+        help = 'import the same entries twice, to benchmark an import that changes nothing')
+    parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
+
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
+
+    print 'Durations in seconds'
+    print '{:>8} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('Entries', 'Import', 'Total',
+        *(tuple(duration_name.capitalize() for duration_name in reported_durations_name) + ('Entries/s',)))
+    for count in [int(count) for count in args.counts.split(',')]:
+        random.seed(args.seed)
+        server = FakeCkanServer(latency = args.latency)
+        server_thread = threading.Thread(target = server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        work_dir = tempfile.mkdtemp(prefix = '{}-{}-'.format(app_name, count))
+        try:
+            for data_file_name in data_files_name:
+                os.symlink(os.path.join(script_dir, data_file_name), os.path.join(work_dir, data_file_name))
+            with open(os.path.join(work_dir, 'etalab-to-ckan.ini'), 'w') as config_file:
+                config_file.write('\n'.join([
+                    '[Etalab-to-CKAN]',
+                    'ckan.api_key = benchmark',
+                    'ckan.site_url = {}'.format(server.url.rstrip('/')),
+                    'producteurs.url = {}Producteurs'.format(server.url),
+                    'user_agent = {}'.format(app_name),
+                    'wenodata.site_url = http://localhost',
+                    '',
+                    ]))
+
+            # Write the entries in the cache of etalab_to_ckan, so that they are read with --file, without Wenodata.
+            connection = sqlite3.connect(os.path.join(work_dir, etalab_to_ckan.entries_cache_file_path))
+            connection.execute('CREATE TABLE entries (etalab_id TEXT PRIMARY KEY, entry TEXT, hash TEXT, '
+                'modified TEXT)')
+            connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+            connection.executemany('INSERT INTO entries (etalab_id, entry, modified) VALUES (?, ?, ?)', (
+                (etalab_id, json.dumps(entry), entry[u'Date de dernière modification'])
+                for etalab_id, entry in generate_entries(count, args.merged_ratio)
+                ))
+            connection.commit()
+            connection.close()
+
+            for import_index in range(2 if args.twice else 1):
+                with open(os.path.join(work_dir, 'import-{}.log'.format(import_index + 1)), 'w') as log_file:
+                    start_time = time.time()
+                    status = subprocess.call([
+                        sys.executable,
+                        os.path.join(script_dir, 'etalab_to_ckan.py'),
+                        'etalab-to-ckan.ini',
+                        '--file',
+                        '--jobs', str(args.jobs),
+                        '--report', 'rapport-import.json',
+                        ] + (['--processes', str(args.processes)] if args.processes is not None else []),
+                        cwd = work_dir, stderr = subprocess.STDOUT, stdout = log_file)
+                    duration = time.time() - start_time
+                if status != 0:
+                    log.error(u'Import of {} entries failed: see {}'.format(count, log_file.name))
+                    args.keep = True
+                    break
+                with open(os.path.join(work_dir, 'rapport-import.json')) as report_file:
+                    report = json.load(report_file)
+                wall_seconds_by_name = dict(
+                    (name, values['wall_seconds'])
+                    for name, values in report['phases'].items() + report['timings'].items()
+                    )
+                if 'generation' in wall_seconds_by_name:
+                    wall_seconds_by_name['generation'] -= wall_seconds_by_name.get('generation waits for upserts', 0)
+                print '{:>8} {:>7} {:>10.2f} {:>10} {:>10} {:>10} {:>10} {:>10.0f}'.format(count, import_index + 1,
+                    duration, *(tuple(
+                        '{:.2f}'.format(wall_seconds_by_name[duration_name])
+                        if duration_name in wall_seconds_by_name else '-'
+                        for duration_name in reported_durations_name
+                        ) + (count / duration,)))
+                log.info(u'CKAN requests: {}'.format(u', '.join(
+                    u'{} {}'.format(requests['count'], action)
+                    for action, requests in sorted(report['ckan_requests'].iteritems())
+                    )))
+        finally:
+            server.shutdown()
+            server.server_close()
+            if args.keep:
+                print 'Working directory kept: {}'.format(work_dir)
+            else:
+                shutil.rmtree(work_dir)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-to-CKAN -- Tools to help migration of data.gouv.fr to CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-to-ckan
+#
+# This file is part of Etalab-to-CKAN.
+#
+# Etalab-to-CKAN is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-to-CKAN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark the matching of datasets titles with title merging rules and check that both algorithms agree."""
+
+
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import time
+
+import etalab_to_ckan
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+log = logging.getLogger(app_name)
+# Titles matching at least one title merging rule
+merged_titles = [
+    u"Aides versées, pour l'exercice 2012",
+    u"Cotations des fruits et légumes semaine 12 2013",
+    u"Données fiscales - année 2011 -",
+    u"Effectifs d'élèves à la rentrée 2012",
+    u"Effectifs des personnes écrouées. Situation au 1er janvier 2013",
+    u"Effectifs étudiants 2011-2012",
+    u"Faits constatés annuels par index 4001 et par département en 2011",
+    u"Faits constatés par départements janvier 2012",
+    u"Faits constatés Zone Police",
+    u"Fréquentation 2006-2010 des Musées de France - Bretagne",
+    u"Impôt sur le revenu 2010 Paris",
+    u"IMPÔT SUR LE REVENU (revenus de 2009) Communes de plus de 50 000 habitants 2010",
+    u"Indicateurs de résultats des lycées - actualisation 2012",
+    u"Jaune 2013 - Personnels Cabinets Ministériels - Premier ministre",
+    u"Liste des Immeubles protégés au titre des Monuments Historiques - Alsace",
+    u"Observatoire des prix et des marges des produits frais - janvier 2013",
+    u"Population légale au 1er janvier 2012",
+    u"REI 2011 Gironde",
+    u"Registre Parcellaire Graphique : contours des îlots culturaux et leur groupe de cultures majoritaire des "
+    u"exploitations - Ain",
+    u"Rôles de taxe foncière émis en 2010 communes",
+    u"Statistiques trimestrielles de la population prise en charge en milieu fermé. 2e trimestre 2012",
+    u"Taux de fiscalité directe locale et délibérations 2012 Ain",
+    ]
+words = u"""
+    accidents aides annuaire budget carte catalogue collectivités communes comptes données effectifs enquête
+    équipements établissements état fichier indicateurs inventaire liste localisation nombre population
+    publics recensement répartition résultats services sportifs statistiques subventions transports
+    """.split()
+
+
+def generate_titles(count, merged_ratio):
+    titles = []
+    for index in range(count):
+        if random.random() < merged_ratio:
+            titles.append(random.choice(merged_titles))
+        else:
+            titles.append(u' '.join(random.sample(words, random.randint(3, 10))).capitalize())
+    return titles
+
+
+def match_title_merging_rules_naively(organization_title, service_title, package_title):
+    """Try every title merging rule of a service in turn, like it was done before the combined regular expressions."""
+    matches = []
+    for rule_index, rule in enumerate(etalab_to_ckan.title_merging_rules[organization_title][service_title]):
+        package_title_re = rule[0]
+        match = package_title_re.match(package_title)
+        if match is not None:
+            matches.append((rule_index, rule, match))
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-c', '--cache', action = 'store_true',
+        help = 'use the titles of the entries in the local cache of etalab_to_ckan instead of generated ones')
+    parser.add_argument('-n', '--count', default = 100000, help = 'number of generated titles', type = int)
+    parser.add_argument('-r', '--merged-ratio', default = 0.05,
+        help = 'ratio of generated titles that match a title merging rule', type = float)
+    parser.add_argument('-s', '--seed', default = 0, help = 'seed of random generator', type = int)
+    parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
+
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
+
+    if args.cache:
+        connection = sqlite3.connect(etalab_to_ckan.entries_cache_file_path)
+        titles = [
+            u' '.join(json.loads(entry_json)['Titre'].split())
+            for entry_json, in connection.execute('SELECT entry FROM entries')
+            ]
+        connection.close()
+    else:
+        random.seed(args.seed)
+        titles = generate_titles(args.count, args.merged_ratio)
+    services_title = [
+        (organization_title, service_title)
+        for organization_title, organization_title_merging_rules in etalab_to_ckan.title_merging_rules.iteritems()
+        for service_title in organization_title_merging_rules
+        ]
+
+    duration_by_algorithm = {}
+    matches_by_algorithm = {}
+    for algorithm, match_title_merging_rules in (
+            ('naive', match_title_merging_rules_naively),
+            ('indexed', etalab_to_ckan.match_title_merging_rules),
+            ):
+        matches = []
+        start_time = time.time()
+        for organization_title, service_title in services_title:
+            for title in titles:
+                for rule_index, rule, match in match_title_merging_rules(organization_title, service_title, title):
+                    matches.append((organization_title, service_title, title, rule_index, match.groupdict()))
+        duration_by_algorithm[algorithm] = time.time() - start_time
+        matches_by_algorithm[algorithm] = matches
+
+    assert matches_by_algorithm['indexed'] == matches_by_algorithm['naive'], \
+        'Indexed and naive algorithms give different matches'
+    print '{} titles x {} services, {} matches'.format(len(titles), len(services_title),
+        len(matches_by_algorithm['naive']))
+    for algorithm in ('naive', 'indexed'):
+        print '{}: {:.3f} s ({:.1f} µs per title and service)'.format(algorithm, duration_by_algorithm[algorithm],
+            duration_by_algorithm[algorithm] * 1000000 / (len(titles) * len(services_title)))
+    print 'Speedup: {:.1f}x'.format(duration_by_algorithm['naive'] / duration_by_algorithm['indexed'])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
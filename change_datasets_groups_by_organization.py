@@ -28,31 +28,74 @@
 
 
 import argparse
+import collections
 import ConfigParser
 import csv
 import datetime
-import json
 import logging
 import os
 import sys
-import urllib
-import urllib2
-import urlparse
 
-from biryani1 import baseconv, custom_conv, states, strings
+from biryani1 import baseconv, custom_conv, states
 
 from ckantoolbox import ckanconv
 
+from ckan_client import CkanClient, WorkerPool
+import slugs
+
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
+args = None
+ckan_client = None
 conv = custom_conv(baseconv, ckanconv, states)
+list_page_size = 25  # Default maximum number of groups or organizations listed by CKAN with all their fields
 log = logging.getLogger(app_name)
+organizations_per_search_count = 50
+
+
+def change_membership(action, group_name, package_name):
+    """Add (when action is member_create) or remove (when action is member_delete) a package to or from a group."""
+    data = dict(
+        id = group_name,
+        object = package_name,
+        object_type = 'package',
+        )
+    if action == 'member_create':
+        data['capacity'] = 'public'
+    ckan_client.action(action, data)
+
+
+def list_all(action):
+    """Return every group or organization (depending on action), with all its fields.
+
+    Items are requested page by page, because CKAN limits the number of items listed with all their fields.
+    """
+    items = []
+    items_name = set()
+    while True:
+        page = ckan_client.action(action, all_fields = True, limit = list_page_size, offset = len(items))['result']
+        # Stop at the first empty page, or at the first page already seen, when CKAN ignores the offset.
+        if not page or page[0]['name'] in items_name:
+            return items
+        items.extend(page)
+        items_name.update(item['name'] for item in page)
 
 
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument('config', help = 'path of configuration file')
     parser.add_argument('csv_file_path', help = 'path of CSV file containing the groups to use by organization')
+    parser.add_argument('-d', '--dry-run', action = 'store_true',
+        help = "only print the changes of groups, don't update CKAN repository")
+    parser.add_argument('-j', '--jobs', default = 4, help = 'number of groups changes done concurrently',
+        type = int)
+    parser.add_argument('-l', '--max-latency', default = 10.0,
+        help = 'duration (in seconds) of a CKAN request above which fewer requests are sent concurrently', type = float)
+    parser.add_argument('-m', '--max-rate', help = 'maximum number of CKAN requests per second', type = float)
+    parser.add_argument('-n', '--retries', default = 5,
+        help = 'number of retries of a CKAN request failing with a transient error', type = int)
+    parser.add_argument('-T', '--timeout', default = 60.0, help = 'timeout (in seconds) of CKAN requests',
+        type = float)
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
 
     global args
@@ -86,15 +129,16 @@ def main():
         conv.not_none,
         ))(dict(config_parser.items('Change-datasets-groups-by-organization')), conv.default_state)
 
-    ckan_headers = {
+    global ckan_client
+    ckan_client = CkanClient(conf['ckan.site_url'], headers = {
         'Authorization': conf['ckan.api_key'],
         'User-Agent': conf['user_agent'],
-        }
+        }, max_concurrency = args.jobs, max_latency = args.max_latency, max_rate = args.max_rate,
+        retries = args.retries, timeout = args.timeout)
 
-    group_by_name = {}
+    # First, parse the whole CSV file, to know every organization and group it uses.
+    group_title_by_name = {}
     groups_name_by_organization_name = {}
-    organization_by_id = {}
-    organization_by_name = {}
     with open(args.csv_file_path) as csv_file:
         csv_reader = csv.reader(csv_file)
         csv_reader.next()
@@ -105,100 +149,117 @@ def main():
                 ]
             if organization_title is None or group1_title is None:
                 continue
-            organization_name = strings.slugify(organization_title)[:100]
-            if organization_name not in organization_by_name:
-                request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                    '/api/3/action/organization_show?id={}'.format(organization_name)), headers = ckan_headers)
-                try:
-                    response = urllib2.urlopen(request)
-                except urllib2.HTTPError as response:
-                    if response.code == 404:
-                        log.warning(u'Skipping missing organization: {}'.format(organization_name))
-                        continue
-                    raise
-                else:
-                    response_dict = json.loads(response.read())
-                    organization = response_dict['result']
-                    organization_by_id[organization['id']] = organization
-                    organization_by_name[organization_name] = organization
+            organization_name = slugs.slugify(organization_title)[:100]
+            organization_groups_name = groups_name_by_organization_name.setdefault(organization_name, set())
             for group_title in (group1_title, group2_title):
                 if group_title is None:
                     continue
-                group_name = strings.slugify(group_title)[:100]
-                if group_name not in group_by_name:
-                    request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                        '/api/3/action/group_show?id={}'.format(group_name)), headers = ckan_headers)
-                    try:
-                        response = urllib2.urlopen(request)
-                    except urllib2.HTTPError as response:
-                        if response.code == 404:
-                            log.info(u'Creating group: {}'.format(group_name))
-                            request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                                '/api/3/action/group_create'), headers = ckan_headers)
-                            response = urllib2.urlopen(request, urllib.quote(json.dumps(dict(
-                                name = group_name,
-                                title = group_title
-                                ))))
-                            response_dict = json.loads(response.read())
-                            group_by_name[group_name] = response_dict['result']
-                        else:
-                            raise
-                    else:
-                        response_dict = json.loads(response.read())
-                        group_by_name[group_name] = response_dict['result']
-                groups_name_by_organization_name.setdefault(organization_name, set()).add(group_name)
-
-    # Retrieve names of packages already existing in CKAN.
-    request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'], '/api/3/action/package_list'),
-        headers = ckan_headers)
-    response = urllib2.urlopen(request)
-    response_dict = json.loads(response.read())
-    packages_name = conv.check(conv.pipe(
-        conv.ckan_json_to_name_list,
-        conv.not_none,
-        ))(response_dict['result'], state = conv.default_state)
-
-    for package_name in packages_name:
-        request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-            '/api/3/action/package_show?id={}'.format(package_name)), headers = ckan_headers)
-        response = urllib2.urlopen(request)
-        response_dict = json.loads(response.read())
-        package = conv.check(conv.pipe(
-            conv.make_ckan_json_to_package(drop_none_values = True),
-            conv.not_none,
-            conv.ckan_input_package_to_output_package,
-            ))(response_dict['result'], state = conv.default_state)
-        organization_id = package.get('owner_org')
-        organization = organization_by_id.get(organization_id)
+                group_name = slugs.slugify(group_title)[:100]
+                group_title_by_name.setdefault(group_name, group_title)
+                organization_groups_name.add(group_name)
+
+    log.info(u'Slugs: {} from memo, {} computed'.format(slugs.slugify_calls_count['hit'],
+        slugs.slugify_calls_count['miss']))
+
+    # Then resolve all of them at once, retrieving the existing groups and organizations concurrently.
+    list_pool = WorkerPool(list_all, jobs = 2)
+    for action in ('group_list', 'organization_list'):
+        list_pool.submit(action)
+    group_by_name = {}
+    organization_by_name = {}
+    for (action,), items, error in list_pool.join():
+        if error is not None:
+            raise error
+        item_by_name = group_by_name if action == 'group_list' else organization_by_name
+        for item in items:
+            item_by_name[item['name']] = item
+    organization_by_id = {}
+    for organization_name in sorted(groups_name_by_organization_name):
+        organization = organization_by_name.get(organization_name)
         if organization is None:
+            log.warning(u'Skipping missing organization: {}'.format(organization_name))
+            del groups_name_by_organization_name[organization_name]
             continue
-        groups_name = set(
-            group['name']
-            for group in (package.get('groups') or [])
-            )
-        organization_groups_name = groups_name_by_organization_name[organization['name']]
-        for group_name in organization_groups_name:
-            if group_name not in groups_name:
-                log.info(u'Adding group {} to package {}'.format(group_name, package['name']))
-                request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                    '/api/3/action/member_create'), headers = ckan_headers)
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(dict(
-                    capacity = 'public',
-                    id = group_name,
-                    object = package['name'],
-                    object_type = 'package',
-                    ))))
-                response_dict = json.loads(response.read())
-        for group_name in groups_name:
-            if group_name not in organization_groups_name:
-                log.info(u'Removing group {} from package {}'.format(group_name, package['name']))
-                request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                    '/api/3/action/member_delete'), headers = ckan_headers)
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(dict(
-                    id = group_name,
-                    object = package['name'],
-                    object_type = 'package',
-                    ))))
+        organization_by_id[organization['id']] = organization
+
+    # Create the missing groups in one batch.
+    missing_groups_name = sorted(
+        group_name
+        for group_name in set().union(*groups_name_by_organization_name.itervalues())
+        if group_name not in group_by_name
+        )
+    for group_name in missing_groups_name:
+        log.info(u'Creating group: {}'.format(group_name))
+    if missing_groups_name and not args.dry_run:
+        create_pool = WorkerPool(ckan_client.action, jobs = args.jobs)
+        for group_name in missing_groups_name:
+            create_pool.submit('group_create', dict(
+                name = group_name,
+                title = group_title_by_name[group_name],
+                ))
+        for arguments, response_dict, error in create_pool.join():
+            if error is not None:
+                raise error
+            group = response_dict['result']
+            group_by_name[group['name']] = group
+
+    # Compute the changes of groups of every package, before changing anything.
+    # Only the packages of the organizations of the CSV file are retrieved, a few organizations at a time, to keep
+    # the URLs short.
+    log.info(u'Retrieving datasets')
+    membership_changes = []
+    organizations_id = sorted(organization_by_id)
+    for index in range(0, len(organizations_id), organizations_per_search_count):
+        packages = ckan_client.iter_packages(fq = u'owner_org:({})'.format(u' OR '.join(
+            u'"{}"'.format(organization_id)
+            for organization_id in organizations_id[index:index + organizations_per_search_count]
+            )))
+        for package in packages:
+            organization = organization_by_id.get(package.get('owner_org'))
+            if organization is None:
+                continue
+            groups_name = set(
+                group['name']
+                for group in (package.get('groups') or [])
+                )
+            organization_groups_name = groups_name_by_organization_name[organization['name']]
+            for group_name in sorted(organization_groups_name - groups_name):
+                membership_changes.append(('member_create', group_name, package['name']))
+            for group_name in sorted(groups_name - organization_groups_name):
+                membership_changes.append(('member_delete', group_name, package['name']))
+
+    # Print the plan of changes.
+    changes_count_by_action = collections.Counter(
+        action
+        for action, group_name, package_name in membership_changes
+        )
+    print 'Changes of groups: {} datasets to add to a group, {} datasets to remove from a group'.format(
+        changes_count_by_action['member_create'], changes_count_by_action['member_delete'])
+    changes_count_by_action_and_group_name = collections.Counter(
+        (action, group_name)
+        for action, group_name, package_name in membership_changes
+        )
+    for (action, group_name), count in sorted(changes_count_by_action_and_group_name.iteritems()):
+        if action == 'member_create':
+            print u'  Add {} datasets to group {}'.format(count, group_name).encode('utf-8')
+        else:
+            print u'  Remove {} datasets from group {}'.format(count, group_name).encode('utf-8')
+    for action, group_name, package_name in membership_changes:
+        if action == 'member_create':
+            log.info(u'Adding group {} to package {}'.format(group_name, package_name))
+        else:
+            log.info(u'Removing group {} from package {}'.format(group_name, package_name))
+    if args.dry_run:
+        return 0
+
+    change_pool = WorkerPool(change_membership, jobs = args.jobs, progress_label = u'Changed groups memberships',
+        total = len(membership_changes))
+    for action, group_name, package_name in membership_changes:
+        change_pool.submit(action, group_name, package_name)
+    change_pool.join()
+    if change_pool.errors_count:
+        log.warning(u'{} changes of groups failed'.format(change_pool.errors_count))
+        return 1
 
     return 0
 
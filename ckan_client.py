@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+
+# Etalab-to-CKAN -- Tools to help migration of data.gouv.fr to CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-to-ckan
+#
+# This file is part of Etalab-to-CKAN.
+#
+# Etalab-to-CKAN is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-to-CKAN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Client of the CKAN API, keeping its HTTP connections alive between requests, and pool of threads to call it.
+
+The client can limit its rate & concurrency of requests and retry the requests failing because the server is overloaded,
+so that a long import doesn't abort because of a transient error.
+"""
+
+
+import collections
+import errno
+import httplib
+import json
+import logging
+import Queue
+import random
+import socket
+import StringIO
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+
+log = logging.getLogger(__name__)
+max_retry_delay = 60.0  # Maximum delay (in seconds) before retrying a request
+retried_statuses = frozenset([502, 503, 504])  # HTTP statuses of the transient errors of an overloaded server
+# Errors of sockets closed by the server: on a kept-alive connection, they mean that the server has closed it.
+stale_connection_errnos = frozenset([errno.ECONNRESET, errno.EPIPE])
+
+
+class CkanClient(object):
+    """Send requests to a CKAN site, reusing one keep-alive connection per host and per thread.
+
+    Responses and errors mimic those of ``urllib2.urlopen``, so that callers can keep on reading ``response.code`` and
+    ``response.read()`` and catching ``urllib2.HTTPError``.
+
+    When a ``metrics.Metrics`` is given, the duration of every request is recorded in it, by CKAN action.
+
+    Requests failing with a connection error, a timeout or a 502, 503 or 504 status are retried up to ``retries`` times,
+    after a jittered exponential delay starting at ``retry_delay`` seconds. Beware that a create request that has
+    timed out may have succeeded: its retry then fails with a validation error.
+
+    When ``max_rate`` is given, no more than this number of requests are sent per second. When ``max_concurrency`` is
+    given, the number of concurrent requests is adapted (up to it) to the latency of the server: see
+    ``ConcurrencyLimiter``.
+    """
+    def __init__(self, site_url, headers = None, max_concurrency = None, max_latency = None, max_rate = None,
+            metrics = None, retries = 0, retry_delay = 1.0, timeout = None):
+        self.concurrency_limiter = ConcurrencyLimiter(max_concurrency, max_latency = max_latency) \
+            if max_concurrency is not None else None
+        self.headers = headers or {}
+        self.local = threading.local()
+        self.metrics = metrics
+        self.rate_limiter = TokenBucket(max_rate) if max_rate is not None else None
+        self.retries = retries
+        self.retries_count = collections.Counter()
+        self.retry_delay = retry_delay
+        self.site_url = site_url
+        self.timeout = timeout
+
+    def action(self, name, data = None, **params):
+        """Call a CKAN API action and return its decoded JSON response."""
+        response = self.urlopen('/api/3/action/{}'.format(name), data = data, params = params)
+        return json.loads(response.read())
+
+    def close(self):
+        for connection in getattr(self.local, 'connection_by_host', {}).itervalues():
+            connection.close()
+        self.local.connection_by_host = {}
+
+    def get_connection(self, scheme, netloc):
+        connection_by_host = getattr(self.local, 'connection_by_host', None)
+        if connection_by_host is None:
+            connection_by_host = self.local.connection_by_host = {}
+        connection = connection_by_host.get((scheme, netloc))
+        if connection is None:
+            connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            connection = connection_by_host[(scheme, netloc)] = connection_class(netloc, timeout = self.timeout)
+            connection.requests_count = 0
+        return connection
+
+    def drop_connection(self, scheme, netloc):
+        connection = self.local.connection_by_host.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def iter_packages(self, rows = 1000, **params):
+        """Iterate over the packages found by package_search, requesting them page by page."""
+        start = 0
+        while True:
+            response_dict = self.action('package_search', rows = rows, sort = 'name asc', start = start, **params)
+            packages = response_dict['result']['results']
+            for package in packages:
+                yield package
+            start += len(packages)
+            if not packages or start >= response_dict['result']['count']:
+                break
+
+    def urlopen(self, path, data = None, params = None):
+        """Send a GET request (or a POST one when data is given) and return its response.
+
+        ``data`` is a JSON-serializable object, sent quoted, like CKAN expects it.
+        """
+        url = urlparse.urljoin(self.site_url, path)
+        if params:
+            url = u'{}?{}'.format(url, urllib.urlencode(sorted(
+                (key, value.encode('utf-8') if isinstance(value, unicode) else value)
+                for key, value in params.iteritems()
+                )))
+        split_url = urlparse.urlsplit(url)
+        selector = split_url.path or '/'
+        if split_url.query:
+            selector = '{}?{}'.format(selector, split_url.query)
+        headers = self.headers.copy()
+        if data is None:
+            body = None
+            method = 'GET'
+        else:
+            body = urllib.quote(json.dumps(data))
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            method = 'POST'
+        action = path.rsplit('/', 1)[-1]
+        attempt = 0
+        while True:
+            try:
+                response, response_text = self.send(action, method, split_url, selector, body, headers)
+            except (httplib.HTTPException, socket.error) as error:
+                if attempt >= self.retries:
+                    raise
+                retry_after = None
+            else:
+                if response.status not in retried_statuses or attempt >= self.retries:
+                    break
+                error = u'{} {}'.format(response.status, response.reason)
+                retry_after = response.getheader('Retry-After')
+            # Full jitter: waiting a random part of the exponential delay spreads the retries of concurrent requests.
+            delay = random.uniform(0, min(max_retry_delay, self.retry_delay * 2 ** attempt))
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, min(max_retry_delay, int(retry_after)))
+            attempt += 1
+            self.retries_count[action] += 1
+            log.warning(u'Retrying {} in {:.1f} seconds (attempt {} / {}) after error: {}'.format(action, delay,
+                attempt, self.retries, error))
+            time.sleep(delay)
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg,
+                StringIO.StringIO(response_text))
+        return urllib.addinfourl(StringIO.StringIO(response_text), response.msg, url, code = response.status)
+
+    def send(self, action, method, split_url, selector, body, headers):
+        """Send a request once (waiting for the rate and concurrency limits) and return its response and its text."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        if self.concurrency_limiter is not None:
+            self.concurrency_limiter.acquire()
+        started_at = time.time()
+        overloaded = True
+        try:
+            while True:
+                connection = self.get_connection(split_url.scheme, split_url.netloc)
+                try:
+                    connection.request(method, selector, body, headers)
+                    response = connection.getresponse()
+                    response_text = response.read()
+                except (httplib.HTTPException, socket.error) as error:
+                    self.drop_connection(split_url.scheme, split_url.netloc)
+                    # Only the request sent on a kept-alive connection closed by the server is sent again at once. Other
+                    # errors (like timeouts) may happen after the server has received it: urlopen retries them later.
+                    stale_connection = isinstance(error, httplib.BadStatusLine) \
+                        or isinstance(error, socket.error) and error.errno in stale_connection_errnos
+                    if connection.requests_count == 0 or not stale_connection:
+                        if self.metrics is not None:
+                            self.metrics.record_request(action, time.time() - started_at, error = True)
+                        raise
+                    # The server has closed a kept-alive connection before receiving the request: retry on a new one.
+                    log.debug(u'Reconnecting to {}'.format(split_url.netloc))
+                    continue
+                connection.requests_count += 1
+                if response.will_close:
+                    self.drop_connection(split_url.scheme, split_url.netloc)
+                break
+            overloaded = response.status in retried_statuses
+        finally:
+            if self.concurrency_limiter is not None:
+                self.concurrency_limiter.release(started_at, overloaded = overloaded)
+        if self.metrics is not None:
+            self.metrics.record_request(action, time.time() - started_at, error = response.status >= 400)
+        return response, response_text
+
+
+class ConcurrencyLimiter(object):
+    """Limit of the number of concurrent requests, adapted to the server by additive increase & multiplicative decrease.
+
+    The limit grows by about one request each time a limit's worth of requests have succeeded, and is halved when a
+    request takes more than max_latency seconds or fails because the server is overloaded. Only one decrease is done
+    for the requests sent before the previous decrease, so that a burst of slow responses halves the limit only once.
+    """
+    def __init__(self, max_limit, max_latency = None, min_limit = 1):
+        self.condition = threading.Condition()
+        self.decreased_at = 0
+        self.in_flight = 0
+        self.limit = float(max_limit)
+        self.max_latency = max_latency
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, started_at, overloaded = False):
+        now = time.time()
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded or self.max_latency is not None and now - started_at > self.max_latency:
+                if started_at >= self.decreased_at:
+                    self.decreased_at = now
+                    self.limit = max(float(self.min_limit), self.limit / 2)
+                    log.debug(u'Concurrency limit decreased to {}'.format(int(self.limit)))
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+class TokenBucket(object):
+    """Limit the rate of events to ``rate`` per second, allowing bursts of ``burst`` events."""
+    def __init__(self, rate, burst = None):
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.lock = threading.Lock()
+        self.rate = float(rate)
+        self.tokens = self.burst
+        self.updated_at = time.time()
+
+    def acquire(self):
+        """Take a token, waiting until it is available."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # Tokens are taken in advance, so that waiting callers are served in order.
+            self.tokens -= 1
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class WorkerPool(object):
+    """Bounded pool of threads calling the same function, each call being isolated from the errors of others.
+
+    When a callback is given, it is called (one call at a time) with the (arguments, result, error) triple of each call,
+    instead of keeping it in results.
+
+    When a progress label is given, progress is logged every progress_step calls.
+    """
+    def __init__(self, function, callback = None, jobs = 1, progress_label = None, progress_step = 100, total = None):
+        self.callback = callback
+        self.calls_count = 0
+        self.errors_count = 0
+        self.function = function
+        self.lock = threading.Lock()
+        self.progress_label = progress_label
+        self.progress_step = progress_step
+        self.queue = Queue.Queue(maxsize = max(jobs, 1) * 2)
+        self.results = []
+        self.total = total
+        self.threads = [
+            threading.Thread(target = self.work)
+            for index in range(max(jobs, 1))
+            ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def join(self):
+        """Wait for the completion of all submitted calls and return their (arguments, result, error) triples."""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.results
+
+    def submit(self, *arguments):
+        # Blocks when enough calls are already waiting, to bound memory usage.
+        self.queue.put(arguments)
+
+    def work(self):
+        while True:
+            arguments = self.queue.get()
+            if arguments is None:
+                return
+            try:
+                result = self.function(*arguments)
+            except Exception as error:
+                log.exception(u'An exception occured while calling {0}'.format(self.function.__name__))
+                result = None
+            else:
+                error = None
+            with self.lock:
+                self.calls_count += 1
+                if error is not None:
+                    self.errors_count += 1
+                if self.callback is None:
+                    self.results.append((arguments, result, error))
+                else:
+                    self.callback(arguments, result, error)
+                if self.progress_label is not None and self.calls_count % self.progress_step == 0:
+                    log.info(u'{}: {} / {} ({} errors)'.format(self.progress_label, self.calls_count,
+                        self.total if self.total is not None else u'?', self.errors_count))
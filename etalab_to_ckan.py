@@ -31,21 +31,33 @@ import argparse
 import collections
 import ConfigParser
 import csv
+import datetime
+import errno
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 #import pprint
 import random
 import re
+import sqlite3
 import sys
-import urllib
+import threading
+import time
 import urllib2
 import urlparse
+import uuid
 
-from biryani1 import baseconv, custom_conv, datetimeconv, states, strings
+from biryani1 import baseconv, custom_conv, datetimeconv, states
+from ckan_client import CkanClient, WorkerPool
 from ckantoolbox import ckanconv
 from lxml import etree
+from metrics import Metrics
 import pymongo
+from records import Package, Resource
+import slugs
+from staging import StagingStore
 from suq import monpyjama
 from territoria2 import territories
 import wenoio
@@ -59,20 +71,20 @@ def extract_merged_package_title(match):
 
 
 def make_merged_package_resources_cleaner(*fields):
-    def cleanup_merged_package_resources(merged_package, package, vars, same_notes = False):
+    def cleanup_merged_package_resources(merged_resources_by_url, package, vars, same_notes = False):
+        """Rename the resources of a package merged into another and remove those already in the merged package.
+
+        merged_resources_by_url is the index of the resources of the merged package, maintained by the caller.
+        """
         if same_notes:
             resource_description = None
         else:
             resource_description = package.get('notes')
             # Set to empty string instead of None (or removing it) to ensure that previous value in CKAN is erased.
             package['notes'] = u''
-        merged_resources_by_url = dict(
-            (resource['url'], resource)
-            for resource in merged_package['resources']
-            if resource.get('url')
-            ) if merged_package is not None else {}
-        resource_index = 0
-        for resource in package['resources'][:]:
+        resources = []
+        for resource in package['resources']:
+            resource_index = len(resources)
             if resource_index == 0 and resource_description:
                 if resource.get('description'):
                     resource['description'] = u'{}\n\n{}'.format(resource_description, resource['description'])
@@ -92,7 +104,6 @@ def make_merged_package_resources_cleaner(*fields):
                 # Remove fields from resource name.
                 existing_resource['name'] = u' - '.join(resource_name_fragments)
                 # Don't add new resource.
-                del package['resources'][resource_index]
                 continue
             for field in fields:
                 field_value = vars.get(field)
@@ -110,27 +121,56 @@ def make_merged_package_resources_cleaner(*fields):
 #                    resource_name_fragments[0] = resource_name_fragments[0][:-char_count_to_remove] + u'...'
 #                resource_name = u' - '.join(resource_name_fragments)
             resource['name'] = resource_name
-            resource_index += 1
+            resources.append(resource)
+        package['resources'] = resources
 
     return cleanup_merged_package_resources
 
 
+def make_title_merging_re(rules):
+    """Combine the regular expressions of title merging rules into one, matching when any of them matches.
+
+    Return None when the regular expressions can't be combined.
+    """
+    patterns = []
+    for package_title_re, merged_package_title_extractor, repetition_type, merged_package_resources_cleaner in rules:
+        pattern = package_title_re.pattern
+        if not pattern.startswith(u'(?i)') or u'(?P=' in pattern:
+            return None
+        # Named groups can't be repeated in the combined regular expression.
+        patterns.append(u'(?:{})'.format(re.sub(ur'\(\?P<\w+>', u'(?:', pattern[len(u'(?i)'):])))
+    return re.compile(u'(?i){}'.format(u'|'.join(patterns)))
+
+
 #
 
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
 args = None
-ckan_headers = None
+checkpoint_journal_file = None
+checkpoint_journal_file_path = 'journal-import.txt'
+checkpoint_journal_lock = threading.Lock()  # The journal is written by the callbacks of the upsert & staging pools
+checkpoint_journal_writes_count = 0
+checkpointed_package_id_and_hash_by_name = {}  # Packages already upserted by the interrupted import being resumed
+ckan_client = None
 conf = None
 conv = custom_conv(baseconv, ckanconv, datetimeconv, states)
+entries_cache_file_path = 'fiches-data.gouv.fr.sqlite'
+entry_state_by_etalab_id = {}  # Last modification date, hash & package name of each entry imported or skipped
 etalab_package_name_re = re.compile(ur'.+-(?P<etalab_id>\d{6,8})$')
 existing_groups_name = None
 existing_packages_name = None
 existing_organizations_name = None
+existing_package_infos_by_name = {}
+failed_packages_infos = []
+generation_batch_size = 500  # Number of entries sent at once to a process generating packages
 group_id_by_name = {}
 group_name_by_organization_name = {}
 grouped_packages = {}
 html_parser = etree.HTMLParser()
+incremental_state_file_path = 'etat-import-incremental.json'
+iso_datetime_re = re.compile(ur'(?P<year>\d{4})-(?P<month>\d\d)-(?P<day>\d\d)'
+    ur'([T ](?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)(\.(?P<fraction>\d{1,6}))?)?$')
 ignored_organization_infos_by_name = {
     u'bouches-du-rhone-tourisme': dict(delete_packages = True),
     u'institut-national-de-l-information-geographique-et-forestiere': dict(delete_packages = False),
@@ -148,6 +188,8 @@ license_id_by_title = {
     u'Licence Ouverte/Open Licence': u'fr-lo',
     }
 log = logging.getLogger(app_name)
+merge_pattern_by_slug_by_service = {}  # Pattern of the first merge group of each slug, by organization & service
+metrics = Metrics()
 organization_group_line_re = re.compile(ur'(?P<organization>.+)\s+\d+\s+(?P<group>.+)$')
 package_by_name = {}
 packages_merge = []
@@ -155,14 +197,21 @@ new_organization_by_name = {}
 notes_merging_rules = {
     u"Ministère de la Culture et de la Communication": {
         u"Département des études, de la prospective et des statistiques": [
-            strings.slugify(u'''Statistiques : résultats de l'enquête 2008 "Les Pratiques Culturelles des Français"'''),
+            slugs.slugify(u'''Statistiques : résultats de l'enquête 2008 "Les Pratiques Culturelles des Français"'''),
             ],
         },
     }
+notes_slug_hash_by_package_name = {}  # SHA-1 of the slug of the description of each mergeable package
 organization_id_by_name = {}
 organization_titles_by_slug = {}
+pending_etalab_id_and_entry_state_by_package_name = {}
 period_re = re.compile(ur'du (?P<day_from>[012]\d|3[01])/(?P<month_from>0\d|1[012])/(?P<year_from>[012]\d\d\d)'
     ur' au (?P<day_to>[012]\d|3[01])/(?P<month_to>0\d|1[012])/(?P<year_to>[012]\d\d\d|9999)$')
+previous_entry_state_by_etalab_id = {}
+staging_pool = None  # Pool writing the batches of the staging store, not to block the upsert threads
+staging_store = None
+territory_by_spec_key = {}
+territory_lookups_count = collections.Counter()
 title_merging_rules = {
     u"Agence de services et de paiement": {
         None: [
@@ -461,33 +510,595 @@ title_merging_rules = {
             ],
         },
     }
+title_merging_re_by_organization_and_service = dict(
+    ((organization_title, service_title), make_title_merging_re(service_title_merging_rules))
+    for organization_title, organization_title_merging_rules in title_merging_rules.iteritems()
+    for service_title, service_title_merging_rules in organization_title_merging_rules.iteritems()
+    )
+upsert_actions_count = collections.Counter()
+
+
+def bulk_delete_packages(owner_org, names):
+    """Delete in one request packages belonging to the same organization."""
+    ckan_client.action('bulk_update_delete', dict(
+        datasets = [
+            existing_package_infos_by_name[name]['id']
+            for name in names
+            ],
+        org_id = owner_org,
+        ))
+
+
+def close_checkpoint_journal(remove = False):
+    global checkpoint_journal_file
+    if checkpoint_journal_file is None:
+        return
+    checkpoint_journal_file.flush()
+    os.fsync(checkpoint_journal_file.fileno())
+    checkpoint_journal_file.close()
+    checkpoint_journal_file = None
+    if remove:
+        os.remove(checkpoint_journal_file_path)
+
+
+def count_upserted_package(arguments, action, error):
+    package_name, package = arguments
+    if error is None:
+        upsert_actions_count[action] += 1
+    if action == u'staged':
+        # A staged package is not in CKAN yet, so it is not recorded in the incremental state: the next import will
+        # upsert it again. It is written in the checkpoint journal only if the fallback of the store creates it in CKAN.
+        pending_etalab_id_and_entry_state_by_package_name.pop(package_name, None)
+        if len(staging_store.pending) >= args.bulk_size:
+            # The batch is only detached here, while the upsert threads wait for this callback: it is written (or
+            # created & updated in CKAN when it can't be written) by the staging pool.
+            staging_pool.submit(staging_store.detach())
+    else:
+        finish_package_upsert(package_name, package, action, error)
+
+
+def create_package(package, fail_if_name_used = True):
+    """Create a package in CKAN, give it the id of the created package and return True.
+
+    When fail_if_name_used is false, return False when CKAN rejects the name of the package as already used (by a
+    deleted package, for example), instead of failing.
+    """
+    try:
+        response = ckan_client.urlopen('/api/3/action/package_create', data = package)
+    except urllib2.HTTPError as response:
+        response_text = response.read()
+        try:
+            response_dict = json.loads(response_text)
+        except ValueError:
+            log.error(u'An exception occured while creating package: {0}'.format(package))
+            log.error(response_text)
+            raise
+        if not fail_if_name_used and response.code == 409 and u'name' in (response_dict.get('error') or {}):
+            return False
+        log.error(u'An exception occured while creating package: {0}'.format(package))
+        for key, value in response_dict.iteritems():
+            log.debug('{} = {}'.format(key, value))
+        raise
+    assert response.code == 200
+    response_dict = json.loads(response.read())
+    assert response_dict['success'] is True
+    created_package = response_dict['result']
+#    pprint.pprint(created_package)
+    package['id'] = created_package['id']
+    return True
+
+
+def delete_package(name):
+    # TODO: To replace with package_purge when it is available.
+    ckan_client.action('package_delete', dict(id = existing_package_infos_by_name[name]['id']), id = name)
+
+
+def find_territory(territory_spec):
+    """Return the territory matching a spec, retrieving it from MongoDB only the first time."""
+    territory_spec_key = json.dumps(territory_spec, sort_keys = True)
+    territory = territory_by_spec_key.get(territory_spec_key, UnboundLocalError)
+    if territory is UnboundLocalError:
+        territory_lookups_count['miss'] += 1
+        if getattr(monpyjama.Wrapper, 'db', None) is None:
+            # Connect to MongoDB only when a territory is needed, so that entries without territories don't need it.
+            monpyjama.Wrapper.db = pymongo.Connection().souk
+        with metrics.timing('territories lookups'):
+            territory = territory_by_spec_key[territory_spec_key] = territories.Territory.find_one(territory_spec)
+    else:
+        territory_lookups_count['hit'] += 1
+    return territory
+
+
+def finish_package_upsert(package_name, package, action, error):
+    etalab_id_and_entry_state = pending_etalab_id_and_entry_state_by_package_name.pop(package_name, None)
+    if error is None:
+        if etalab_id_and_entry_state is not None:
+            etalab_id, entry_state = etalab_id_and_entry_state
+            entry_state_by_etalab_id[etalab_id] = entry_state
+        if checkpoint_journal_file is not None and action != u'resumed':
+            write_checkpoint(package_name, package['id'], hash_package(package))
+    else:
+        failed_packages_infos.append((package_name, package['title'], error))
+
+
+def finish_staged_packages(arguments, written, error):
+    """Finish the upserts of the packages of a batch of the staging store written in CKAN instead."""
+    packages, = arguments
+    if error is not None:
+        written = [
+            (action, package_name, package, error)
+            for action, package_name, package in packages
+            ]
+    for action, package_name, package, package_error in written:
+        finish_package_upsert(package_name, package, action, package_error)
+
+
+def generate_package(etalab_id, entry):
+    """Generate the package of a data.gouv.fr entry, with the infos needed to merge it with other packages.
+
+    Neither CKAN nor MongoDB are used, so that packages can be generated by other processes: organization, groups and
+    territorial coverage are added to the package by the caller. Return None when the entry is ignored.
+    """
+    etalab_id_str = str(etalab_id)
+    package_title = u' '.join(entry['Titre'].split())  # Cleanup multiple spaces.
+    package_name = u'{}-{}'.format(slugs.slugify(package_title)[:100 - len(etalab_id_str) - 1], etalab_id_str)
+    source_slug = slugs.slugify(entry.get('Source'))
+    organization_titles = organization_titles_by_slug.get(source_slug)
+    if organization_titles is None:
+        organization_title = entry.get('Source')
+        service_title = None
+    else:
+        organization_title, service_title = organization_titles
+    organization_name = slugs.slugify(organization_title)[:100]
+    if organization_name in ignored_organization_infos_by_name:
+        return None
+    generated = dict(
+        entry_state = None,
+        etalab_id = unicode(etalab_id),
+        organization_name = organization_name,
+        organization_title = organization_title,
+        package = None,
+        package_name = package_name,
+        service_title = service_title,
+        )
+
+    service_title_merging_rules = title_merging_rules.get(organization_title, {}).get(service_title)
+    service_notes_merging_rules = notes_merging_rules.get(organization_title, {}).get(service_title)
+    if service_title_merging_rules is None and service_notes_merging_rules is None:
+        # Package will never be merged, so it can be skipped when its entry has not changed since last import.
+        entry_state = generated['entry_state'] = [
+            entry.get(u'Date de dernière modification'),
+            hashlib.sha1(json.dumps(entry, sort_keys = True)).hexdigest(),
+            package_name,
+            ]
+        # The package must also still exist in CKAN: it may have been deleted there since last import.
+        if args.incremental and previous_entry_state_by_etalab_id.get(unicode(etalab_id)) == entry_state \
+                and package_name in existing_package_infos_by_name:
+            return generated
+
+    frequency = entry.get(u'Fréquence de mise à jour')
+    if frequency is not None:
+        frequency = frequency.lower()
+        frequency = {
+            u"au fil de l'eau": u"ponctuelle",
+            }.get(frequency, frequency)
+    license_id = conv.check(conv.pipe(
+        conv.test_in(license_id_by_title),
+        conv.translate(license_id_by_title)
+        ))(entry.get('Licence', {}).get('Titre'), state = conv.default_state)
+    # Extras are indexed by key until the package is converted to CKAN format, just before its upsert.
+    extras = collections.OrderedDict(
+        (key, value)
+        for key, value in entry.iteritems()
+        if key not in (
+            u'Couverture géographique',
+            u'Date de dernière modification',
+            u'Date de publication',
+            u'Description',
+            u'Documents annexes',
+            u'Données',
+            u'Fréquence de mise à jour',
+            u'Licence',
+            u'Mots-clés',
+            u'Période',
+            u'Source',
+            u'Titre',
+            )
+        if isinstance(value, basestring)
+        )
+
+    resources = []
+    for data in entry.get(u'Données', []) + entry.get(u'Documents annexes', []):
+        resource_name = u' '.join(data['Titre'].split()) if data.get('Titre') else None  # Cleanup spaces.
+        resource_name = {
+            u'Accéder au service de téléchargement': None,
+            u'Télécharger': None,
+            }.get(resource_name, resource_name)
+        format = data.get('Format')
+        resources.append(Resource(
+            created = entry.get(u'Date de publication'),
+            format = format.upper() if format is not None else None,
+            last_modified = entry.get(u'Date de dernière modification'),
+            name = resource_name,
+            # package_id (string) – id of package that the resource needs should be added to.
+            url = data['URL'],
+#                revision_id – (optional)
+#                description (string) – (optional)
+#                hash (string) – (optional)
+#                resource_type (string) – (optional)
+#                mimetype (string) – (optional)
+#                mimetype_inner (string) – (optional)
+#                webstore_url (string) – (optional)
+#                cache_url (string) – (optional)
+#                size (int) – (optional)
+#                cache_last_updated (iso date string) – (optional)
+#                webstore_last_updated (iso date string) – (optional)
+            ))
+
+    package = Package(
+        author = service_title or u'',  # TODO
+#                author_email = u'',
+        extras = extras,
+        frequency = {
+            u'journalier': u"quotidienne",
+            }.get(frequency, frequency),
+        # groups is added by the caller.
+        license_id = license_id,
+        maintainer = u'',
+#            maintainer_email = u'',
+        name = package_name,
+        notes = entry.get('Description'),
+        # owner_org is added by the caller.
+#                relationships_as_object (list of relationship dictionaries) – see package_relationship_create() for the format of relationship dictionaries (optional)
+#                relationships_as_subject (list of relationship dictionaries) – see package_relationship_create() for the format of relationship dictionaries (optional)
+        resources = resources,
+        # state = 'active',
+        # Only the names of the tags are kept, until the package is converted to CKAN format.
+        tags = tuple(
+            tag_name
+            for tag_name in (
+                slugs.slugify(keyword)[:100]
+                for keyword in entry.get(u'Mots-clés', [])
+                if keyword is not None
+                )
+            if len(tag_name) >= 2
+            ),
+        title = package_title,
+#                type (string) – the type of the dataset (optional), IDatasetForm plugins associate themselves with different dataset types and provide custom dataset handling behaviour for these types
+#                url (string) – a URL for the dataset’s source (optional)
+#                version (string, no longer than 100 characters) – (optional)
+        )
+
+    period = entry.get(u'Période')
+    if period is not None:
+        match = period_re.match(period)
+        if match is not None:
+            package['temporal_coverage_from'] = u'{}-{}-{}'.format(match.group('year_from'),
+                match.group('month_from'), match.group('day_from'))
+            year_to = match.group('year_to')
+            if year_to == u'9999':
+                year_to = '2013'
+            package['temporal_coverage_to'] = u'{}-{}-{}'.format(year_to, match.group('month_to'),
+                match.group('day_to'))
+
+    generated['package'] = package
+    generated['territorial_coverage'] = entry.get(u'Territoires couverts')
+
+    # Find the title merging rules matching the package and the slug of its description, to group it later.
+    if service_title_merging_rules is not None:
+        title_merging_matches = match_title_merging_rules(organization_title, service_title, package_title)
+        generated['title_merging_matches'] = [
+            (rule_index, dict(title_match.groupdict(),
+                merged_package_title = merged_package_title_extractor(title_match)))
+            for rule_index, (package_title_re, merged_package_title_extractor, repetition_type,
+                merged_package_resources_cleaner), title_match in title_merging_matches
+            ]
+        # When at least one rule doesn't match the title, the package is also kept ungrouped.
+        generated['title_merging_rules_missed'] = len(title_merging_matches) < len(service_title_merging_rules)
+
+    if generated['entry_state'] is None:
+        # Keep only a hash of the slug of the description, to compare it with the ones of the other packages of its
+        # merge groups, without slugifying it again.
+        notes_slug = slugs.slugify(package.get('notes'), memoize = False) or None
+        generated['notes_slug_hash'] = hashlib.sha1(notes_slug.encode('utf-8')).digest() \
+            if notes_slug is not None else None
+        generated['notes_merging_rule_index'] = None
+        if notes_slug is not None and service_notes_merging_rules is not None:
+            for rule_index, rule_notes_slug in enumerate(service_notes_merging_rules, 100):
+                if notes_slug == rule_notes_slug:
+                    generated['notes_merging_rule_index'] = rule_index
+                    break
+    return generated
+
+
+def generate_packages(etalab_ids_and_entries):
+    """Generate the packages of a batch of entries (in another process)."""
+    return [
+        generate_package(etalab_id, entry)
+        for etalab_id, entry in etalab_ids_and_entries
+        ]
+
+
+def get_incremental_fingerprint():
+    """Return a hash of the files that, besides the entries, are used to generate packages.
+
+    When one of them changes, an incremental import must import all the entries again.
+    """
+    fingerprint = hashlib.sha1()
+    for file_path in (
+            __file__.replace('.pyc', '.py'),
+            'organizations-groups.txt',
+            'organizations-hierarchy.txt',
+            'producteurs-orphelins.txt',
+            ):
+        with open(file_path) as data_file:
+            fingerprint.update(data_file.read())
+    return fingerprint.hexdigest()
 
 
 def get_package_extra(package, key, default = UnboundLocalError):
-    for extra in package['extras']:
-        if extra['key'] == key:
-            return extra['value']
-    if default is UnboundLocalError:
+    """Return the value of an extra of a generated package, whose extras are indexed by key."""
+    value = package['extras'].get(key, default)
+    if value is UnboundLocalError:
         raise KeyError(key)
-    return default
+    return value
+
+
+def hash_package(package):
+    """Return a hash of the content of a package, restricted to the fields generated by this script.
+
+    Custom fields (like temporal coverage) are hashed with the extras, because CKAN stores them either as fields or as
+    extras, depending on its schema. Dates are hashed in the format returned by CKAN. Groups are ignored, because
+    existing groups are kept when updating.
+    """
+    extras = dict(
+        (extra['key'], extra['value'])
+        for extra in (package.get('extras') or [])
+        if extra.get('value') and extra.get('state', 'active') == 'active'
+        )
+    for key in (u'frequency', u'temporal_coverage_from', u'temporal_coverage_to'):
+        if package.get(key):
+            extras[key] = package[key]
+    for key in (u'temporal_coverage_from', u'temporal_coverage_to'):
+        if key in extras:
+            extras[key] = normalize_date(extras[key])
+    canonical_package = dict(
+        (key, package[key])
+        for key in (u'author', u'license_id', u'maintainer', u'name', u'notes', u'owner_org', u'title')
+        if package.get(key)
+        )
+    canonical_package[u'extras'] = extras
+    canonical_package[u'resources'] = [
+        dict(
+            (key, normalize_date(resource[key]) if key in (u'created', u'last_modified') else resource[key])
+            for key in (u'created', u'description', u'format', u'last_modified', u'name', u'url')
+            if resource.get(key)
+            )
+        for resource in (package.get('resources') or [])
+        ]
+    canonical_package[u'tags'] = sorted(
+        tag['name']
+        for tag in (package.get('tags') or [])
+        )
+    return hashlib.sha1(json.dumps(canonical_package, sort_keys = True)).hexdigest()
+
+
+def index_existing_package(package):
+    """Keep only the infos of an existing CKAN package needed to update or delete it."""
+    return dict(
+        groups = [
+            group['id']
+            for group in (package.get('groups') or [])
+            ],
+        hash = hash_package(package),
+        id = package['id'],
+        name = package['name'],
+        organization = (package.get('organization') or {}).get('name'),
+        owner_org = package.get('owner_org'),
+        state = package.get('state') or 'active',
+        )
+
+
+def iter_entries():
+    """Iterate over the (etalab_id, entry) couples of data.gouv.fr, one at a time, without loading them all.
+
+    Entries are read from a local SQLite cache of the Wenodata store, which is refreshed (only changed entries are
+    written) unless --file is used or the cache is younger than --cache-ttl.
+    """
+    if args.file and not os.path.exists(entries_cache_file_path):
+        # Don't let SQLite create an empty cache: importing no entry would delete every existing dataset.
+        raise IOError(errno.ENOENT, 'Missing cache of data.gouv.fr entries', entries_cache_file_path)
+    connection = sqlite3.connect(entries_cache_file_path)
+    try:
+        connection.execute("""\
+            CREATE TABLE IF NOT EXISTS entries (
+                etalab_id TEXT PRIMARY KEY,
+                entry TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                modified TEXT
+                )
+            """)
+        connection.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)')
+        row = connection.execute("SELECT value FROM metadata WHERE key = 'refreshed_at'").fetchone()
+        refreshed_at = float(row[0]) if row is not None else None
+        if args.file or refreshed_at is not None and args.cache_ttl is not None \
+                and time.time() - refreshed_at < args.cache_ttl * 3600:
+            log.info(u'Reading data.gouv.fr entries from cache')
+            entries_count = connection.execute('SELECT count(*) FROM entries').fetchone()[0]
+            assert entries_count > 1, entries_count
+            for etalab_id, entry_json in connection.execute('SELECT etalab_id, entry FROM entries ORDER BY etalab_id'):
+                yield etalab_id, json.loads(entry_json, object_pairs_hook = collections.OrderedDict)
+            return
+
+        log.info(u'Loading data.gouv.fr entries from Wenodata')
+        changed_entries_count = 0
+        entries_count = 0
+        connection.execute('CREATE TEMP TABLE seen_entries (etalab_id TEXT PRIMARY KEY)')
+        job = wenoio.init(server_url = conf['wenodata.site_url'])
+        with job.dataset('/comarquage/metanol/fiches_data.gouv.fr').open(job) as store, \
+                open('jeux-de-donnees-ignores.txt', 'w') as ignored_packages_file:
+            ignored_packages_csv_writer = csv.writer(ignored_packages_file, delimiter = ';', quotechar = '"',
+                quoting = csv.QUOTE_MINIMAL)
+            ignored_packages_csv_writer.writerow([
+                'Organisation',
+                'Jeu de données',
+                ])
+            for etalab_id, entry in store.iteritems():
+                # Ignore datasets that are part of a (frequently used) web-service.
+                ignore_dataset = False
+                for data in entry.get(u'Données', []):
+                    url = data.get('URL')
+                    if url is None:
+                        continue
+                    url = url.split('?', 1)[0]
+                    if url in (
+                            u'http://www.bdm.insee.fr/bdm2/choixCriteres.action',  # 2104
+                            u'http://www.bdm.insee.fr/bdm2/exporterSeries.action',  # 2104
+                            u'http://www.recensement-2008.insee.fr/chiffresCles.action',  # 281832
+                            u'http://www.recensement-2008.insee.fr/exportXLS.action',  # 9996
+                            u'http://www.recensement-2008.insee.fr/exportXLSCC.action',  # 281832
+                            u'http://www.recensement-2008.insee.fr/tableauxDetailles.action',  # 9996
+                            u'http://www.stats.environnement.developpement-durable.gouv.fr/Eider/selection_series_popup.do',  # 55553
+                            ):
+                        ignore_dataset = True
+                        break
+                if ignore_dataset:
+                    ignored_packages_csv_writer.writerow([
+                        entry[u'Source'].encode('utf-8'),
+                        entry[u'Titre'].encode('utf-8'),
+                        ])
+                    continue
+                etalab_id = unicode(etalab_id)
+                entry_json = json.dumps(entry)
+                entry_hash = hashlib.sha1(entry_json).hexdigest()
+                row = connection.execute('SELECT hash FROM entries WHERE etalab_id = ?', (etalab_id,)).fetchone()
+                if row is None or row[0] != entry_hash:
+                    connection.execute('INSERT OR REPLACE INTO entries (etalab_id, entry, hash, modified) '
+                        'VALUES (?, ?, ?, ?)', (etalab_id, entry_json, entry_hash,
+                        entry.get(u'Date de dernière modification')))
+                    changed_entries_count += 1
+                connection.execute('INSERT OR IGNORE INTO seen_entries (etalab_id) VALUES (?)', (etalab_id,))
+                entries_count += 1
+                yield etalab_id, entry
+        assert entries_count > 1, entries_count
+        deleted_entries_count = connection.execute(
+            'DELETE FROM entries WHERE etalab_id NOT IN (SELECT etalab_id FROM seen_entries)').rowcount
+        connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('refreshed_at', ?)",
+            (unicode(time.time()),))
+        # Cache is committed only once the whole store has been read, to keep the previous one when loading fails.
+        connection.commit()
+        log.info(u'Refreshed cache of data.gouv.fr entries: {} entries, {} changed, {} deleted'.format(
+            entries_count, changed_entries_count, deleted_entries_count))
+    finally:
+        connection.close()
+
+
+def iter_generated_packages(entries, pool = None):
+    """Generate the packages of entries, in the order of entries, using a pool of processes when one is given.
+
+    Entries are sent to the processes by batches and only a few batches are pending at any time, to bound memory usage.
+    """
+    if pool is None:
+        for etalab_id, entry in entries:
+            yield generate_package(etalab_id, entry)
+        return
+    batch = []
+    pending_results = collections.deque()
+    for etalab_id_and_entry in entries:
+        batch.append(etalab_id_and_entry)
+        if len(batch) >= generation_batch_size:
+            pending_results.append(pool.apply_async(generate_packages, (batch,)))
+            batch = []
+            if len(pending_results) > args.processes * 2:
+                for generated in pending_results.popleft().get():
+                    yield generated
+    if batch:
+        pending_results.append(pool.apply_async(generate_packages, (batch,)))
+    while pending_results:
+        for generated in pending_results.popleft().get():
+            yield generated
+
+
+def load_checkpoint_journal():
+    """Return the CKAN id & hash of each package upserted by the interrupted import whose journal is resumed."""
+    package_id_and_hash_by_name = {}
+    if not os.path.exists(checkpoint_journal_file_path):
+        log.info(u'Missing checkpoint journal: Importing all entries')
+        return package_id_and_hash_by_name
+    with open(checkpoint_journal_file_path) as journal_file:
+        try:
+            header = json.loads(journal_file.readline())
+        except ValueError:
+            header = None
+        if header is None or header.get('fingerprint') != get_incremental_fingerprint():
+            log.info(u'Script or its data files have changed since interrupted import: Importing all entries')
+            return package_id_and_hash_by_name
+        for line in journal_file:
+            try:
+                package_name, package_id, package_hash = json.loads(line)
+            except ValueError:
+                # The last line may have been only partially written when the import was interrupted.
+                break
+            package_id_and_hash_by_name[package_name] = (package_id, package_hash)
+    log.info(u'Resuming interrupted import: {} datasets already upserted'.format(len(package_id_and_hash_by_name)))
+    return package_id_and_hash_by_name
+
+
+def load_incremental_state():
+    """Return the state of the entries at the end of the last import."""
+    if not os.path.exists(incremental_state_file_path):
+        log.info(u'Missing incremental state: Importing all entries')
+        return {}
+    with open(incremental_state_file_path) as state_file:
+        state = json.load(state_file)
+    if state['fingerprint'] != get_incremental_fingerprint():
+        log.info(u'Script or its data files have changed since last import: Importing all entries')
+        return {}
+    return state['entry_state_by_etalab_id']
 
 
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument('config', help = 'path of configuration file')
+    parser.add_argument('-b', '--bulk-size', default = 100,
+        help = 'number of datasets deleted (or written in staging store) by each bulk request', type = int)
+    parser.add_argument('-c', '--checkpoint-interval', default = 100,
+        help = 'number of upserted datasets between two synchronizations of checkpoint journal on disk', type = int)
     parser.add_argument('-d', '--dry-run', action = 'store_true',
         help = "simulate import, don't update CKAN repository")
-    parser.add_argument('-f', '--file', action = 'store_true', help = "load packages from file")
-    parser.add_argument('-o', '--offset', help = 'index of first dataset to import', type = int)
+    parser.add_argument('-f', '--file', action = 'store_true',
+        help = "load entries from local cache, without refreshing it from Wenodata")
+    parser.add_argument('-i', '--incremental', action = 'store_true',
+        help = 'only import the entries that have changed since last import')
+    parser.add_argument('-j', '--jobs', default = 4, help = 'number of packages upserted concurrently', type = int)
+    parser.add_argument('-l', '--max-latency', default = 10.0,
+        help = 'duration (in seconds) of a CKAN request above which fewer requests are sent concurrently', type = float)
+    parser.add_argument('-m', '--max-rate', help = 'maximum number of CKAN requests per second', type = float)
+    parser.add_argument('-n', '--retries', default = 5,
+        help = 'number of retries of a CKAN request failing with a transient error', type = int)
+    parser.add_argument('-P', '--processes', default = multiprocessing.cpu_count(),
+        help = 'number of processes generating packages', type = int)
+    parser.add_argument('-p', '--prometheus',
+        help = 'path of file where to write the metrics of the import, in Prometheus text format')
     parser.add_argument('-r', '--reset', action = 'store_true',
         help = 'erase content of CKAN database not imported by this script')
+    parser.add_argument('--resume', action = 'store_true',
+        help = "resume an interrupted import, without upserting again the datasets of its checkpoint journal")
+    parser.add_argument('-s', '--report', default = 'rapport-import.json',
+        help = 'path of file where to write the JSON report of the durations of the import phases & CKAN requests')
+    parser.add_argument('-S', '--staging',
+        help = 'path of SQLite staging store where to write the created & updated datasets, instead of CKAN '
+            '(they are not recorded as imported, for --incremental & --resume)')
+    parser.add_argument('-t', '--cache-ttl', help = "maximum age (in hours) of local cache before refreshing it",
+        type = float)
+    parser.add_argument('-T', '--timeout', default = 60.0, help = 'timeout (in seconds) of CKAN requests',
+        type = float)
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
 
     global args
     args = parser.parse_args()
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
 
-    monpyjama.Wrapper.db = pymongo.Connection().souk
     territories.Territory.collection_name = 'territories'
 
     config_parser = ConfigParser.SafeConfigParser(dict(
@@ -508,6 +1119,10 @@ def main():
                         full = True),
                     conv.not_none,
                     ),
+                'producteurs.url': conv.pipe(
+                    conv.make_input_to_url(full = True),
+                    conv.default(u'http://www.data.gouv.fr/Producteurs'),
+                    ),
                 'user_agent': conv.pipe(
                     conv.cleanup_line,
                     conv.not_none,
@@ -523,54 +1138,45 @@ def main():
         conv.not_none,
         ))(dict(config_parser.items('Etalab-to-CKAN')), conv.default_state)
 
-    global ckan_headers
-    ckan_headers = {
+    global ckan_client
+    ckan_client = CkanClient(conf['ckan.site_url'], headers = {
         'Authorization': conf['ckan.api_key'],
         'User-Agent': conf['user_agent'],
-        }
-
-    # Retrieve names of packages already existing in CKAN.
-    request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'], '/api/3/action/package_list'),
-        headers = ckan_headers)
-    response = urllib2.urlopen(request)
-    response_dict = json.loads(response.read())
+        }, max_concurrency = args.jobs, max_latency = args.max_latency, max_rate = args.max_rate, metrics = metrics,
+        retries = args.retries, timeout = args.timeout)
+
+    # Retrieve packages already existing in CKAN, page by page.
+    metrics.start_phase('ckan listing')
+    log.info(u'Indexing existing datasets')
+    for existing_package in ckan_client.iter_packages():
+        existing_package_infos = index_existing_package(existing_package)
+        existing_package_infos_by_name[existing_package_infos['name']] = existing_package_infos
     global existing_packages_name
     if args.reset:
         # Keep the names of all existing datasets.
-        existing_packages_name = set(conv.check(conv.pipe(
-            conv.ckan_json_to_name_list,
-            conv.not_none,
-            ))(response_dict['result'], state = conv.default_state))
+        existing_packages_name = set(existing_package_infos_by_name)
     else:
         # Keep only the names of all existing Etalab datasets.
         existing_packages_name = set(
             package_name
-            for package_name in conv.check(conv.pipe(
-                conv.ckan_json_to_name_list,
-                conv.not_none,
-                ))(response_dict['result'], state = conv.default_state)
+            for package_name in existing_package_infos_by_name
             if etalab_package_name_re.match(package_name) is not None
             )
 
     # Retrieve names of groups already existing in CKAN.
-    request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'], '/api/3/action/group_list'),
-        headers = ckan_headers)
-    response = urllib2.urlopen(request)
-    response_dict = json.loads(response.read())
+    response_dict = ckan_client.action('group_list')
     global existing_groups_name
     existing_groups_name = set(response_dict['result'])
 
     # Retrieve names of organizations already existing in CKAN.
-    request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'], '/api/3/action/organization_list'),
-        headers = ckan_headers)
-    response = urllib2.urlopen(request)
-    response_dict = json.loads(response.read())
+    response_dict = ckan_client.action('organization_list')
     global existing_organizations_name
     existing_organizations_name = set(response_dict['result'])
 
     # Load organizations from data.gouv.fr.
+    metrics.start_phase('producteurs scraping')
     log.info('Updating organizations from data.gouv.fr')
-    response = urllib2.urlopen('http://www.data.gouv.fr/Producteurs')
+    response = urllib2.urlopen(conf['producteurs.url'])
     html_element = etree.fromstring(response.read(), html_parser)
     for organization_element in html_element.iterfind('.//div[@class="resultatliste_item clearfix"]'):
         title = organization_element.findtext('section[@class="detail"]/h2/a')
@@ -583,22 +1189,23 @@ def main():
                 ]
             if fragment
             )
-        image_url = urlparse.urljoin('http://www.data.gouv.fr/',
+        image_url = urlparse.urljoin(conf['producteurs.url'],
             organization_element.find('section[@class="annexe"]/img').get('src'))
-        new_organization_by_name[strings.slugify(title)[:100]] = dict(
+        new_organization_by_name[slugs.slugify(title)[:100]] = dict(
             description = description,
             image_url = image_url,
             title = title,
             )
 
     # Load hierarchy of organizations from file.
+    metrics.start_phase('hierarchy loading')
     log.info('Updating organizations hierarchy from file')
     with open('organizations-hierarchy.txt') as organizations_file:
         for line in organizations_file:
             line = line.decode('utf-8').strip()
             assert line.count(u';;') == 2, line.encode('utf-8')
             old_title, main_title, sub_title = line.split(u';;')
-            old_slug = strings.slugify(old_title)
+            old_slug = slugs.slugify(old_title)
             main_title = main_title.strip() or None
             if main_title is not None:
                 organization_titles_by_slug[old_slug] = (main_title, sub_title.strip() or None)
@@ -613,7 +1220,7 @@ def main():
             line = line.decode('utf-8')
             if u';;' in line:
                 if name is not None:
-                    new_organization_by_name[strings.slugify(name)[:100]] = dict(
+                    new_organization_by_name[slugs.slugify(name)[:100]] = dict(
                         description = description,
                         image_url = image_url,
                         )
@@ -625,12 +1232,13 @@ def main():
             else:
                 description += u'\n' + line.rstrip()
         if name is not None:
-            new_organization_by_name[strings.slugify(name)[:100]] = dict(
+            new_organization_by_name[slugs.slugify(name)[:100]] = dict(
                 description = description,
                 image_url = image_url,
                 )
 
     # Create or update default group and read their associations with organizations.
+    metrics.start_phase('groups upsert')
     log.info('Updating groups')
     groups_title = []
     with open('organizations-groups.txt') as organizations_groups_file:
@@ -650,181 +1258,60 @@ def main():
             if match.group('group') not in groups_title:
                 log.warning(u'Unexpected group in line: {}'.format(line))
                 groups_title.append(match.group('group'))
-            group_name_by_organization_name[strings.slugify(match.group('organization'))] = strings.slugify(match.group(
+            group_name_by_organization_name[slugs.slugify(match.group('organization'))] = slugs.slugify(match.group(
                 'group'))
     for group_title in groups_title:
         log.info(u'Upserting group {0}'.format(group_title))
         upsert_group(title = group_title)
 
-    if args.file:
-        log.info(u'Reading data.gouv.fr entries from file')
-        with open('fiches-data.gouv.fr.json') as entries_file:
-            entry_by_etalab_id = json.load(entries_file, object_pairs_hook = collections.OrderedDict)
-    else:
-        log.info(u'Loading data.gouv.fr entries from Wenodata')
-        entry_by_etalab_id = collections.OrderedDict()
-        job = wenoio.init(server_url = conf['wenodata.site_url'])
-        with job.dataset('/comarquage/metanol/fiches_data.gouv.fr').open(job) as store, \
-                open('jeux-de-donnees-ignores.txt', 'w') as ignored_packages_file:
-            ignored_packages_csv_writer = csv.writer(ignored_packages_file, delimiter = ';', quotechar = '"',
-                quoting = csv.QUOTE_MINIMAL)
-            ignored_packages_csv_writer.writerow([
-                'Organisation',
-                'Jeu de données',
-                ])
-            for etalab_id, entry in store.iteritems():
-                # Ignore datasets that are part of a (frequently used) web-service.
-                ignore_dataset = False
-                for data in entry.get(u'Données', []):
-                    url = data.get('URL')
-                    if url is None:
-                        continue
-                    url = url.split('?', 1)[0]
-                    if url in (
-                            u'http://www.bdm.insee.fr/bdm2/choixCriteres.action',  # 2104
-                            u'http://www.bdm.insee.fr/bdm2/exporterSeries.action',  # 2104
-                            u'http://www.recensement-2008.insee.fr/chiffresCles.action',  # 281832
-                            u'http://www.recensement-2008.insee.fr/exportXLS.action',  # 9996
-                            u'http://www.recensement-2008.insee.fr/exportXLSCC.action',  # 281832
-                            u'http://www.recensement-2008.insee.fr/tableauxDetailles.action',  # 9996
-                            u'http://www.stats.environnement.developpement-durable.gouv.fr/Eider/selection_series_popup.do',  # 55553
-                            ):
-                        ignore_dataset = True
-                        break
-                if ignore_dataset:
-                    ignored_packages_csv_writer.writerow([
-                        entry[u'Source'].encode('utf-8'),
-                        entry[u'Titre'].encode('utf-8'),
-                        ])
-                    continue
-                entry_by_etalab_id[etalab_id] = entry
-        assert len(entry_by_etalab_id) > 1, entry_by_etalab_id
-        log.info(u'Writing data.gouv.fr entries to file')
-        with open('fiches-data.gouv.fr.json', 'w') as entries_file:
-            json.dump(entry_by_etalab_id, entries_file)
+    if args.incremental:
+        previous_entry_state_by_etalab_id.update(load_incremental_state())
+    if not args.dry_run:
+        if args.resume:
+            checkpointed_package_id_and_hash_by_name.update(load_checkpoint_journal())
+        open_checkpoint_journal()
 
-    log.info('Generating datasets')
-    for index, (etalab_id, entry) in enumerate(entry_by_etalab_id.iteritems()):
-        if args.offset is not None and index < args.offset:
-            continue
+    # Processes generating packages are forked after the data they use is loaded, but before any thread is started.
+    generation_pool = multiprocessing.Pool(args.processes) if args.processes > 1 else None
 
-#        log.info(u'Generating dataset {0} - {1}'.format(index, entry['Titre']))
-
-        etalab_id_str = str(etalab_id)
-        package_title = u' '.join(entry['Titre'].split())  # Cleanup multiple spaces.
-        package_name = u'{}-{}'.format(strings.slugify(package_title)[:100 - len(etalab_id_str) - 1],
-            etalab_id_str)
-        source_slug = strings.slugify(entry.get('Source'))
-        organization_titles = organization_titles_by_slug.get(source_slug)
-        if organization_titles is None:
-            organization_title = entry.get('Source')
-            service_title = None
-        else:
-            organization_title, service_title = organization_titles
-        organization_name = strings.slugify(organization_title)[:100]
-        if organization_name in ignored_organization_infos_by_name:
+    global staging_pool
+    global staging_store
+    if args.staging is not None and not args.dry_run:
+        staging_store = StagingStore(args.staging, fallback = write_staged_package)
+        staging_pool = WorkerPool(staging_store.write, callback = finish_staged_packages, jobs = args.jobs)
+
+    # Packages that can't be merged with others are upserted as soon as they are generated.
+    upsert_pool = WorkerPool(timed_upsert_package, callback = count_upserted_package, jobs = args.jobs,
+        progress_label = u'Upserted datasets')
+
+    # Loading of entries from Wenodata (or its cache) is interleaved with generation, so it is timed separately.
+    metrics.start_phase('generation')
+    log.info('Generating datasets')
+    for generated in iter_generated_packages(metrics.iter_timed('entries loading', iter_entries()),
+            pool = generation_pool):
+        if generated is None:
             continue
+        organization_name = generated['organization_name']
+        organization_title = generated['organization_title']
         organization_id = organization_id_by_name.get(organization_name, UnboundLocalError)
         if organization_id is UnboundLocalError:
             organization_id = upsert_organization(title = organization_title)
-        frequency = entry.get(u'Fréquence de mise à jour')
-        if frequency is not None:
-            frequency = frequency.lower()
-            frequency = {
-                u"au fil de l'eau": u"ponctuelle",
-                }.get(frequency, frequency)
-        license_id = conv.check(conv.pipe(
-            conv.test_in(license_id_by_title),
-            conv.translate(license_id_by_title)
-            ))(entry.get('Licence', {}).get('Titre'), state = conv.default_state)
-        extras = [
-            dict(
-                # deleted = True,
-                key = key,
-                value = value,
-                )
-            for key, value in entry.iteritems()
-            if key not in (
-                u'Couverture géographique',
-                u'Date de dernière modification',
-                u'Date de publication',
-                u'Description',
-                u'Documents annexes',
-                u'Données',
-                u'Fréquence de mise à jour',
-                u'Licence',
-                u'Mots-clés',
-                u'Période',
-                u'Source',
-                u'Titre',
-                )
-            if isinstance(value, basestring)
-            ]
-
-        resources = []
-        for data in entry.get(u'Données', []) + entry.get(u'Documents annexes', []):
-            resource_name = u' '.join(data['Titre'].split()) if data.get('Titre') else None  # Cleanup spaces.
-            resource_name = {
-                u'Accéder au service de téléchargement': None,
-                u'Télécharger': None,
-                }.get(resource_name, resource_name)
-            format = data.get('Format')
-            resources.append(dict(
-                created = entry.get(u'Date de publication'),
-                format = format.upper() if format is not None else None,
-                last_modified = entry.get(u'Date de dernière modification'),
-                name = resource_name,
-                # package_id (string) – id of package that the resource needs should be added to.
-                url = data['URL'],
-#                revision_id – (optional)
-#                description (string) – (optional)
-#                hash (string) – (optional)
-#                resource_type (string) – (optional)
-#                mimetype (string) – (optional)
-#                mimetype_inner (string) – (optional)
-#                webstore_url (string) – (optional)
-#                cache_url (string) – (optional)
-#                size (int) – (optional)
-#                cache_last_updated (iso date string) – (optional)
-#                webstore_last_updated (iso date string) – (optional)
-                ))
 
-        package = dict(
-            author = service_title or u'',  # TODO
-#                author_email = u'',
-            extras = extras,
-            frequency = {
-                u'journalier': u"quotidienne",
-                }.get(frequency, frequency),
-            # groups is added below.
-            license_id = license_id,
-            maintainer = u'',
-#            maintainer_email = u'',
-            name = package_name,
-            notes = entry.get('Description'),
-            owner_org = organization_id,
-#                relationships_as_object (list of relationship dictionaries) – see package_relationship_create() for the format of relationship dictionaries (optional)
-#                relationships_as_subject (list of relationship dictionaries) – see package_relationship_create() for the format of relationship dictionaries (optional)
-            resources = resources,
-            # state = 'active',
-            tags = [
-                dict(
-                    name = tag_name,
-#                        vocabulary_id (string) – the name or id of the vocabulary that the new tag should be added to, e.g. 'Genre'
-                    )
-                for tag_name in (
-                    strings.slugify(keyword)[:100]
-                    for keyword in entry.get(u'Mots-clés', [])
-                    if keyword is not None
-                    )
-                if len(tag_name) >= 2
-                ],
-            title = package_title,
-#                type (string) – the type of the dataset (optional), IDatasetForm plugins associate themselves with different dataset types and provide custom dataset handling behaviour for these types
-#                url (string) – a URL for the dataset’s source (optional)
-#                version (string, no longer than 100 characters) – (optional)
-            )
+        entry_state = generated['entry_state']
+        etalab_id = generated['etalab_id']
+        package = generated['package']
+        package_name = generated['package_name']
+        service_title = generated['service_title']
+        if package is None:
+            # Entry has not changed since last import.
+            existing_packages_name.discard(package_name)
+            entry_state_by_etalab_id[etalab_id] = entry_state
+            upsert_actions_count['skipped'] += 1
+            continue
+        if entry_state is not None:
+            pending_etalab_id_and_entry_state_by_package_name[package_name] = (etalab_id, entry_state)
 
+        package['owner_org'] = organization_id
         group_name = group_name_by_organization_name.get(organization_name)
         if group_name is not None:
             group_id = group_id_by_name.get(group_name)
@@ -833,59 +1320,53 @@ def main():
                     dict(id = group_id),
                     ]
 
-        period = entry.get(u'Période')
-        if period is not None:
-            match = period_re.match(period)
-            if match is not None:
-                package['temporal_coverage_from'] = u'{}-{}-{}'.format(match.group('year_from'),
-                    match.group('month_from'), match.group('day_from'))
-                year_to = match.group('year_to')
-                if year_to == u'9999':
-                    year_to = '2013'
-                package['temporal_coverage_to'] = u'{}-{}-{}'.format(year_to, match.group('month_to'),
-                    match.group('day_to'))
-
-        territorial_coverage = entry.get(u'Territoires couverts')
+        territorial_coverage = generated['territorial_coverage']
         if territorial_coverage:
             set_package_extra(package, u'territorial_coverage', u','.join(
                 u'{}/{}/{}'.format(territory.__class__.__name__, territory.code, territory.main_postal_distribution_str)
                 for territory in (
-                    territories.Territory.find_one(territory_spec)
+                    find_territory(territory_spec)
                     for territory_spec in territorial_coverage
                     )
                 ))
 
+        if entry_state is not None:
+            ckan_package = package.to_ckan()
+            # Submission blocks while the upsert threads are busy: this wait is not generation.
+            with metrics.timing('generation waits for upserts'):
+                upsert_pool.submit(package_name, ckan_package)
+            continue
+
+        # Keep the packages that may be merged until all the packages of their service are generated.
         assert package_name not in package_by_name, package_name
         package_by_name[package_name] = package
 
         # Group packages having the same title except a date and/or other fields (like territory).
         packages_infos_by_pattern = grouped_packages.setdefault(organization_title, {}).setdefault(
             service_title, {})
-        service_title_merging_rules = title_merging_rules.get(organization_title, {}).get(service_title)
-        if service_title_merging_rules is not None:
-            for rule_index, (package_title_re, merged_package_title_extractor, repetition_type,
-                    merged_package_resources_cleaner) in enumerate(service_title_merging_rules):
-                match = package_title_re.match(package_title)
-                if match is None:
-                    packages_infos_by_pattern.setdefault(None, set()).add((package_name, package_title))
-                else:
-                    merged_package_title = merged_package_title_extractor(match)
-                    vars = {}
-                    vars.update(match.groupdict())
-                    vars['merged_package_title'] = merged_package_title
-                    packages_infos_by_pattern.setdefault((rule_index, strings.slugify(merged_package_title),
-                        repetition_type, merged_package_resources_cleaner), []).append((package_name, vars))
+        if 'title_merging_matches' in generated:
+            if generated['title_merging_rules_missed']:
+                packages_infos_by_pattern.setdefault(None, set()).add((package_name, package['title']))
+            service_title_merging_rules = title_merging_rules[organization_title][service_title]
+            merge_pattern_by_slug = merge_pattern_by_slug_by_service.setdefault((organization_title, service_title),
+                {})
+            for rule_index, vars in generated['title_merging_matches']:
+                package_title_re, merged_package_title_extractor, repetition_type, merged_package_resources_cleaner \
+                    = service_title_merging_rules[rule_index]
+                merged_package_slug = slugs.slugify(vars['merged_package_title'])
+                pattern = (rule_index, merged_package_slug, repetition_type, merged_package_resources_cleaner)
+                packages_infos = packages_infos_by_pattern.get(pattern)
+                if packages_infos is None:
+                    packages_infos = packages_infos_by_pattern[pattern] = {}
+                    merge_pattern_by_slug.setdefault(merged_package_slug, pattern)
+                packages_infos[package_name] = vars
 
         # Group packages having the same description.
-        package_notes_slug = strings.slugify(package.get('notes')) or None
-        if package_notes_slug is not None:
-            service_notes_merging_rules = notes_merging_rules.get(organization_title, {}).get(service_title)
-            if service_notes_merging_rules is not None:
-                for rule_index, notes_slug in enumerate(service_notes_merging_rules, 100):
-                    if package_notes_slug == notes_slug:
-                        packages_infos_by_pattern.setdefault((rule_index, None, None, None), []).append((
-                            package_name, dict(merged_package_title = package['notes'])))
-                        break
+        notes_merging_rule_index = generated['notes_merging_rule_index']
+        if notes_merging_rule_index is not None:
+            packages_infos_by_pattern.setdefault((notes_merging_rule_index, None, None, None), {})[package_name] = \
+                dict(merged_package_title = package['notes'])
+        notes_slug_hash_by_package_name[package_name] = generated['notes_slug_hash']
 
 #            elif organization_title == u"Ministère de l'Économie et des Finances":
 #                if service_title == u"Études statistiques en matière fiscale":
@@ -893,7 +1374,7 @@ def main():
 #                    if match is not None:
 #                        package['title'] = package_title = u"Recensement des éléments d'imposition à la fiscalité directe locale (REI)"
 #                        package['name'] = package_name = u'{}-{}'.format(
-#                            strings.slugify(package_title)[:100 - len(etalab_id_str) - 1], etalab_id_str)
+#                            slugs.slugify(package_title)[:100 - len(etalab_id_str) - 1], etalab_id_str)
 #                        package['notes'] = u'''\
 #- Taxe d'habitation
 #- Taxe foncière sur les propriétés bâties
@@ -907,42 +1388,41 @@ def main():
 #                        package[u'temporal_coverage_from'] = u'{}-01-01'.format(match.group('year'))
 #                        package[u'temporal_coverage_to'] = u'{}-12-31'.format(match.group('year'))
 
+    if generation_pool is not None:
+        generation_pool.close()
+        generation_pool.join()
+
+    metrics.start_phase('merging')
     log.info(u'Merging datasets')
     for organization_title, organization_grouped_packages in grouped_packages.iteritems():
         for service_title, packages_infos_by_pattern in organization_grouped_packages.iteritems():
             # First, try to regroup ungrouped packages with a group that uses the name of the package as slug.
+            merge_pattern_by_slug = merge_pattern_by_slug_by_service.get((organization_title, service_title), {})
             ungrouped_packages_infos = packages_infos_by_pattern.pop(None, [])
             for package_name, package_title in ungrouped_packages_infos:
-                package_slug = strings.slugify(package_title)
-                for (rule_index, merged_package_slug, repetition_type, merged_package_resources_cleaner), \
-                        packages_infos in packages_infos_by_pattern.iteritems():
-                    if package_slug == merged_package_slug:
-                        for other_package_name, other_vars in packages_infos:
-                            if package_name == other_package_name:
-                                break
-                        else:
-                            packages_infos.insert(0, (package_name, dict(merged_package_title = package_title)))
-                        break
+                pattern = merge_pattern_by_slug.get(slugs.slugify(package_title))
+                if pattern is not None:
+                    packages_infos_by_pattern[pattern].setdefault(package_name, dict(
+                        merged_package_title = package_title))
             # Merge packages with the same merged_package_slug.
             for (rule_index, merged_package_slug, repetition_type, merged_package_resources_cleaner), packages_infos \
                     in packages_infos_by_pattern.iteritems():
                 if len(packages_infos) == 1:
                     continue
                 merged_package = None
-                packages_infos.sort(key = lambda (package_name, vars): strings.slugify(package_name))
-
-                last_notes_slug = None
-                for package_index, (package_name, vars) in enumerate(packages_infos):
-                    package = package_by_name[package_name]
-                    notes = package.get('notes')
-                    if notes is not None:
-                        notes_slug = strings.slugify(notes) or None
-                        if notes_slug is not None:
-                            if last_notes_slug is None:
-                                last_notes_slug = notes_slug
-                            elif notes_slug != last_notes_slug:
-                                same_notes = False
-                                break
+                merged_resources_by_url = {}
+                packages_infos = sorted(packages_infos.iteritems(),
+                    key = lambda (package_name, vars): slugs.slugify(package_name))
+
+                last_notes_slug_hash = None
+                for package_name, vars in packages_infos:
+                    notes_slug_hash = notes_slug_hash_by_package_name[package_name]
+                    if notes_slug_hash is not None:
+                        if last_notes_slug_hash is None:
+                            last_notes_slug_hash = notes_slug_hash
+                        elif notes_slug_hash != last_notes_slug_hash:
+                            same_notes = False
+                            break
                 else:
                     same_notes = True
 
@@ -969,14 +1449,15 @@ def main():
                         original_first_resource_name = package['resources'][0]['name']
                         if merged_package_resources_cleaner is None:
                             merged_package_resources_cleaner = make_merged_package_resources_cleaner()
-                        merged_package_resources_cleaner(merged_package, package, vars, same_notes = same_notes)
+                        merged_package_resources_cleaner(merged_resources_by_url, package, vars,
+                            same_notes = same_notes)
 
                         if package['resources']:
                             if package_index == 0:
                                 merged_package = package.copy()
                                 merged_package['title'] = vars['merged_package_title']
                                 merged_package['name'] = merged_package_name = u'{}-00000000'.format(
-                                    strings.slugify(merged_package['title'])[:100 - len(u'00000000') - 1])
+                                    slugs.slugify(merged_package['title'])[:100 - len(u'00000000') - 1])
                                 set_package_extra(merged_package, u'territorial_coverage', u'Country/FR/FRANCE')
                                 package_by_name[merged_package_name] = merged_package
                             else:
@@ -988,6 +1469,11 @@ def main():
                                         merged_package[u'temporal_coverage_to'],
                                         package[u'temporal_coverage_to'])
                                 merged_package['resources'].extend(package['resources'])
+                            merged_resources_by_url.update(
+                                (resource['url'], resource)
+                                for resource in package['resources']
+                                if resource.get('url')
+                                )
                             merged_first_resource_name = package['resources'][0]['name']
                         else:
                             original_first_resource_name = None
@@ -1004,47 +1490,91 @@ def main():
                         merged_package['title'],
                         merged_first_resource_name,
                         ))
+    notes_slug_hash_by_package_name.clear()
+
+    metrics.start_phase('upsert')
+    log.info(u'Upserting merged datasets')
+    while package_by_name:
+        package_name, package = package_by_name.popitem()
+        upsert_pool.submit(package_name, package.to_ckan())
+    upsert_pool.join()
+    if staging_store is not None:
+        staging_pool.submit(staging_store.detach())
+        staging_pool.join()
+        staging_store.close()
+        log.info(u'{} datasets written in staging store {}'.format(staging_store.staged_count, args.staging))
+    if not args.dry_run:
+        save_incremental_state()
+    # Journal is kept when some upserts have failed, to be able to retry only them, using --resume.
+    close_checkpoint_journal(remove = not failed_packages_infos)
+    log.info(u'Territories lookups: {} from cache, {} from MongoDB'.format(territory_lookups_count['hit'],
+        territory_lookups_count['miss']))
+    if ckan_client.retries_count:
+        log.warning(u'Retried CKAN requests: {}'.format(u', '.join(
+            u'{} {}'.format(count, action)
+            for action, count in sorted(ckan_client.retries_count.iteritems())
+            )))
+    log.info(u'Slugs: {} from memo, {} computed'.format(slugs.slugify_calls_count['hit'],
+        slugs.slugify_calls_count['miss']))
+    print 'Upserted packages: {}'.format(', '.join(
+        '{} {}'.format(count, action)
+        for action, count in sorted(upsert_actions_count.iteritems())
+        if action is not None
+        ))
 
-    for package_name, package in package_by_name.iteritems():
-        upsert_package(package_name, package)
-
+    metrics.start_phase('deletion')
     print 'Obsolete or ignored packages: {}'.format(existing_packages_name)
     if not args.dry_run:
-        for package_name in existing_packages_name:
-            # Retrieve package id (needed for delete).
-            request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                '/api/3/action/package_show?id={}'.format(package_name)), headers = ckan_headers)
-            response = urllib2.urlopen(request)
-            response_dict = json.loads(response.read())
-            existing_package = response_dict['result']
-
-            ignored_organization_infos = ignored_organization_infos_by_name.get(
-                existing_package.get('organization', {}).get('name'))
-            if ignored_organization_infos is None or ignored_organization_infos['delete_packages']:
-                # TODO: To replace with package_purge when it is available.
-                request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                    '/api/3/action/package_delete?id={}'.format(package_name)), headers = ckan_headers)
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(existing_package)))
-                response_dict = json.loads(response.read())
-#                deleted_package = response_dict['result']
-#                pprint.pprint(deleted_package)
+        # Ownership of packages comes from the index of existing packages, so no package needs to be retrieved.
+        obsolete_packages_name = [
+            existing_package_name
+            for existing_package_name in sorted(existing_packages_name)
+            if ignored_organization_infos_by_name.get(
+                existing_package_infos_by_name[existing_package_name]['organization'], {}).get('delete_packages', True)
+            ]
+        log.info(u'Deleting {} obsolete datasets'.format(len(obsolete_packages_name)))
+        # The packages of each organization are deleted in bulk. Packages without organization or whose bulk deletion
+        # failed are deleted one by one.
+        obsolete_packages_name_by_owner_org = {}
+        for package_name in obsolete_packages_name:
+            obsolete_packages_name_by_owner_org.setdefault(
+                existing_package_infos_by_name[package_name]['owner_org'], []).append(package_name)
+        single_obsolete_packages_name = obsolete_packages_name_by_owner_org.pop(None, [])
+        obsolete_packages_batches = [
+            (owner_org, packages_name[index:index + args.bulk_size])
+            for owner_org, packages_name in sorted(obsolete_packages_name_by_owner_org.iteritems())
+            for index in range(0, len(packages_name), args.bulk_size)
+            ]
+        bulk_delete_pool = WorkerPool(bulk_delete_packages, jobs = args.jobs,
+            progress_label = u'Deleted datasets batches', progress_step = 10, total = len(obsolete_packages_batches))
+        for owner_org, packages_name in obsolete_packages_batches:
+            bulk_delete_pool.submit(owner_org, packages_name)
+        for (owner_org, packages_name), result, error in bulk_delete_pool.join():
+            if error is not None:
+                single_obsolete_packages_name.extend(packages_name)
+        if single_obsolete_packages_name:
+            if bulk_delete_pool.errors_count:
+                log.warning(u'{} bulk deletions failed: Deleting their datasets one by one'.format(
+                    bulk_delete_pool.errors_count))
+            delete_pool = WorkerPool(delete_package, jobs = args.jobs, progress_label = u'Deleted datasets',
+                total = len(single_obsolete_packages_name))
+            for package_name in sorted(single_obsolete_packages_name):
+                delete_pool.submit(package_name)
+            delete_pool.join()
+            if delete_pool.errors_count:
+                log.warning(u'{} obsolete datasets could not be deleted'.format(delete_pool.errors_count))
 
     if args.reset:
+        metrics.start_phase('reset')
         print 'Obsolete groups: {}'.format(existing_groups_name)
         if not args.dry_run:
             for group_name in existing_groups_name:
                 # Retrieve group id (needed for delete).
-                request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                    '/api/3/action/group_show?id={}'.format(group_name)), headers = ckan_headers)
-                response = urllib2.urlopen(request)
-                response_dict = json.loads(response.read())
+                response_dict = ckan_client.action('group_show', id = group_name)
                 existing_group = response_dict['result']
 
                 # TODO: To replace with group_purge when it is available.
-                request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                    '/api/3/action/group_delete?id={}'.format(group_name)), headers = ckan_headers)
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(existing_group)))
-                response_dict = json.loads(response.read())
+                response_dict = ckan_client.action('group_delete', existing_group, id = group_name)
 #                deleted_group = response_dict['result']
 #                pprint.pprint(deleted_group)
 
@@ -1053,20 +1583,28 @@ def main():
         if not args.dry_run:
             for organization_name in existing_organizations_name:
                 # Retrieve organization id (needed for delete).
-                request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                    '/api/3/action/organization_show?id={}'.format(organization_name)), headers = ckan_headers)
-                response = urllib2.urlopen(request)
-                response_dict = json.loads(response.read())
+                response_dict = ckan_client.action('organization_show', id = organization_name)
                 existing_organization = response_dict['result']
 
                 # TODO: To replace with organization_purge when it is available.
-                request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                    '/api/3/action/organization_delete?id={}'.format(organization_name)), headers = ckan_headers)
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(existing_organization)))
-                response_dict = json.loads(response.read())
+                response_dict = ckan_client.action('organization_delete', existing_organization,
+                    id = organization_name)
 #                deleted_organization = response_dict['result']
 #                pprint.pprint(deleted_organization)
 
+    metrics.end_phase()
+    metrics.counts['ckan_retries'] = dict(ckan_client.retries_count)
+    metrics.counts['slugify_calls'] = dict(slugs.slugify_calls_count)
+    metrics.counts['territories_lookups'] = dict(territory_lookups_count)
+    metrics.counts['upserted_packages'] = dict(
+        (action, count)
+        for action, count in upsert_actions_count.iteritems()
+        if action is not None
+        )
+    metrics.write_json(args.report)
+    if args.prometheus is not None:
+        metrics.write_prometheus(args.prometheus, 'etalab_to_ckan')
+
     if packages_merge:
         with open('jeux-de-donnees-fusionnes.txt', 'w') as packages_merge_file:
             packages_merge_csv_writer = csv.writer(packages_merge_file, delimiter = ';', quotechar = '"',
@@ -1085,22 +1623,97 @@ def main():
                     for cell in package_merge
                     ])
 
+    if failed_packages_infos:
+        log.warning(u'{} datasets could not be upserted'.format(len(failed_packages_infos)))
+        with open('jeux-de-donnees-en-erreur.txt', 'w') as failed_packages_file:
+            failed_packages_csv_writer = csv.writer(failed_packages_file, delimiter = ';', quotechar = '"',
+                quoting = csv.QUOTE_MINIMAL)
+            failed_packages_csv_writer.writerow([
+                'Nom',
+                'Jeu de données',
+                'Erreur',
+                ])
+            for package_name, package_title, error in sorted(failed_packages_infos):
+                failed_packages_csv_writer.writerow([
+                    package_name.encode('utf-8'),
+                    package_title.encode('utf-8'),
+                    repr(error),
+                    ])
+        return 1
+
     return 0
 
 
+def match_title_merging_rules(organization_title, service_title, package_title):
+    """Return the (rule_index, rule, match) triples of the title merging rules of a service that match a title.
+
+    Most titles match no rule, so the combined regular expression of the service rules is tried first, to avoid trying
+    every rule in turn.
+    """
+    service_title_merging_re = title_merging_re_by_organization_and_service[(organization_title, service_title)]
+    if service_title_merging_re is not None and service_title_merging_re.match(package_title) is None:
+        return []
+    matches = []
+    for rule_index, rule in enumerate(title_merging_rules[organization_title][service_title]):
+        package_title_re = rule[0]
+        match = package_title_re.match(package_title)
+        if match is not None:
+            matches.append((rule_index, rule, match))
+    return matches
+
+
+def normalize_date(value):
+    """Return an ISO date (with optional time) in the format of the dates returned by CKAN (like 2013-12-31T00:00:00).
+
+    Other values are returned unchanged.
+    """
+    match = iso_datetime_re.match(value) if isinstance(value, basestring) else None
+    if match is None:
+        return value
+    try:
+        return unicode(datetime.datetime(
+            int(match.group('year')),
+            int(match.group('month')),
+            int(match.group('day')),
+            int(match.group('hour') or 0),
+            int(match.group('minute') or 0),
+            int(match.group('second') or 0),
+            int((match.group('fraction') or u'0').ljust(6, u'0')),
+            ).isoformat())
+    except ValueError:
+        return value
+
+
+def open_checkpoint_journal():
+    """Start a new checkpoint journal, containing the packages already upserted by the resumed import (if any).
+
+    Journal is rewritten instead of being appended to, because its last line may be truncated.
+    """
+    global checkpoint_journal_file
+    checkpoint_journal_file = open(checkpoint_journal_file_path, 'w')
+    checkpoint_journal_file.write(json.dumps(dict(fingerprint = get_incremental_fingerprint())) + '\n')
+    for package_name, (package_id, package_hash) in sorted(checkpointed_package_id_and_hash_by_name.iteritems()):
+        checkpoint_journal_file.write(json.dumps([package_name, package_id, package_hash]) + '\n')
+    checkpoint_journal_file.flush()
+    os.fsync(checkpoint_journal_file.fileno())
+
+
+def save_incremental_state():
+    with open(incremental_state_file_path + '.tmp', 'w') as state_file:
+        json.dump(dict(
+            entry_state_by_etalab_id = entry_state_by_etalab_id,
+            fingerprint = get_incremental_fingerprint(),
+            ), state_file)
+    os.rename(incremental_state_file_path + '.tmp', incremental_state_file_path)
+
+
 def set_package_extra(package, key, value):
-    for extra in package['extras']:
-        if extra['key'] == key:
-            extra['value'] = value
-            return
-    package['extras'].append(dict(
-        key = key,
-        value = value,
-        ))
+    """Set the value of an extra of a generated package, keeping its position when the extra already exists."""
+    package['extras'][key] = value
 
 
 def upsert_group(description = None, image_url = None, title = None):
-    name = strings.slugify(title)[:100]
+    name = slugs.slugify(title)[:100]
     group = dict(
         name = name,
         title = title,
@@ -1118,10 +1731,7 @@ def upsert_group(description = None, image_url = None, title = None):
         existing_groups_name.remove(name)
 
         # Retrieve group id (needed for update).
-        request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-            '/api/3/action/group_show?id={}'.format(name)), headers = ckan_headers)
-        response = urllib2.urlopen(request)
-        response_dict = json.loads(response.read())
+        response_dict = ckan_client.action('group_show', id = name)
         existing_group = response_dict['result']
 
         group['id'] = existing_group['id']
@@ -1153,10 +1763,8 @@ def upsert_group(description = None, image_url = None, title = None):
         # Generate a random group iD.
         group['id'] = u'{}-{}'.format(group['name'], random.randrange(1000000))
     else:
-        request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'], '/api/3/action/group_create'),
-            headers = ckan_headers)
         try:
-            response = urllib2.urlopen(request, urllib.quote(json.dumps(group)))
+            response = ckan_client.urlopen('/api/3/action/group_create', data = group)
         except urllib2.HTTPError as response:
             response_text = response.read()
             log.error(u'An exception occured while creating group: {0}'.format(group))
@@ -1183,7 +1791,7 @@ def upsert_group(description = None, image_url = None, title = None):
 
 
 def upsert_organization(description = None, image_url = None, title = None):
-    name = strings.slugify(title)[:100]
+    name = slugs.slugify(title)[:100]
     organization = new_organization_by_name.get(name)
     if organization is None:
         organization = dict(
@@ -1200,10 +1808,7 @@ def upsert_organization(description = None, image_url = None, title = None):
         existing_organizations_name.remove(name)
 
         # Retrieve organization id (needed for update).
-        request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-            '/api/3/action/organization_show?id={}'.format(name)), headers = ckan_headers)
-        response = urllib2.urlopen(request)
-        response_dict = json.loads(response.read())
+        response_dict = ckan_client.action('organization_show', id = name)
         existing_organization = response_dict['result']
 
         organization_infos = organization
@@ -1218,10 +1823,9 @@ def upsert_organization(description = None, image_url = None, title = None):
         organization['state'] = 'active'
 
         if not args.dry_run:
-            request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                '/api/3/action/organization_update?id={}'.format(name)), headers = ckan_headers)
             try:
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(organization)))
+                response = ckan_client.urlopen('/api/3/action/organization_update', data = organization,
+                    params = dict(id = name))
             except urllib2.HTTPError as response:
                 response_text = response.read()
                 log.error(u'An exception occured while updating organization: {0}'.format(organization))
@@ -1245,10 +1849,8 @@ def upsert_organization(description = None, image_url = None, title = None):
         # Generate a random organization iD.
         organization['id'] = u'{}-{}'.format(organization['name'], random.randrange(1000000))
     else:
-        request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'], '/api/3/action/organization_create'),
-            headers = ckan_headers)
         try:
-            response = urllib2.urlopen(request, urllib.quote(json.dumps(organization)))
+            response = ckan_client.urlopen('/api/3/action/organization_create', data = organization)
         except urllib2.HTTPError as response:
             response_text = response.read()
             log.error(u'An exception occured while creating organization: {0}'.format(organization))
@@ -1274,62 +1876,86 @@ def upsert_organization(description = None, image_url = None, title = None):
     return organization['id']
 
 
+def timed_upsert_package(name, package):
+    """Upsert a package, timing the upserts separately from the phases, because they overlap generation."""
+    with metrics.concurrent_timing('upserts'):
+        return upsert_package(name, package)
+
+
+def update_package(name, package):
+    """Update an existing package in CKAN."""
+    try:
+        response = ckan_client.urlopen('/api/3/action/package_update', data = package, params = dict(id = name))
+    except urllib2.HTTPError as response:
+        response_text = response.read()
+        log.error(u'An exception occured while updating package: {0}'.format(package))
+        try:
+            response_dict = json.loads(response_text)
+        except ValueError:
+            log.error(response_text)
+            raise
+        for key, value in response_dict.iteritems():
+            log.debug('{} = {}'.format(key, value))
+        raise
+    assert response.code == 200
+    response_dict = json.loads(response.read())
+    assert response_dict['success'] is True
+#    updated_package = response_dict['result']
+#    pprint.pprint(updated_package)
+
+
 def upsert_package(name, package):
+    """Create or update a package in CKAN and return the action done (or None when simulating)."""
     existing_packages_name.discard(name)
+    checkpointed_package_id_and_hash = checkpointed_package_id_and_hash_by_name.get(name)
+    if checkpointed_package_id_and_hash is not None and checkpointed_package_id_and_hash[1] == hash_package(package):
+        # Package has already been upserted by the interrupted import.
+        package['id'] = checkpointed_package_id_and_hash[0]
+        return u'resumed'
     if not args.dry_run:
-        request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-            'api/3/action/package_show?id={}'.format(name)), headers = ckan_headers)
-        try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as response:
-            if response.code != 404:
-                raise
-            existing_package = {}
-        else:
-            response_text = response.read()
-            try:
-                response_dict = json.loads(response_text)
-            except ValueError:
-                log.error(u'An exception occured while reading package: {0}'.format(package))
-                log.error(response_text)
-                raise
-            existing_package = conv.check(conv.pipe(
-                conv.make_ckan_json_to_package(drop_none_values = True),
-                conv.not_none,
-                ))(response_dict['result'], state = conv.default_state)
-        if existing_package.get('id') is None:
-            # Create package.
-            request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'], 'api/3/action/package_create'),
-                headers = ckan_headers)
+        existing_package_infos = existing_package_infos_by_name.get(name)
+        if existing_package_infos is None and staging_store is None:
+            # Package is missing from the index of active packages, so it is created at once. Its creation fails only
+            # when it exists in another state (deleted, etc): it is then retrieved and updated.
+            if create_package(package, fail_if_name_used = False):
+                return u'created'
+        if existing_package_infos is None:
+            # Package is missing from the index of active packages, but it may exist in another state (deleted, etc).
             try:
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(package)))
+                response = ckan_client.urlopen('/api/3/action/package_show', params = dict(id = name))
             except urllib2.HTTPError as response:
+                if response.code != 404:
+                    raise
+            else:
                 response_text = response.read()
-                log.error(u'An exception occured while creating package: {0}'.format(package))
                 try:
                     response_dict = json.loads(response_text)
                 except ValueError:
+                    log.error(u'An exception occured while reading package: {0}'.format(package))
                     log.error(response_text)
                     raise
-                for key, value in response_dict.iteritems():
-                    log.debug('{} = {}'.format(key, value))
-                raise
-            else:
-                assert response.code == 200
-                response_dict = json.loads(response.read())
-                assert response_dict['success'] is True
-                created_package = response_dict['result']
-#                pprint.pprint(created_package)
-                package['id'] = created_package['id']
+                existing_package = conv.check(conv.pipe(
+                    conv.make_ckan_json_to_package(drop_none_values = True),
+                    conv.not_none,
+                    ))(response_dict['result'], state = conv.default_state)
+                existing_package_infos = index_existing_package(existing_package)
+        if existing_package_infos is None:
+            if staging_store is not None:
+                # Package is given its id now, so that it is known before the package is loaded into CKAN.
+                package['id'] = unicode(uuid.uuid4())
+                staging_store.stage(u'create', name, package)
+                return u'staged'
+            create_package(package)
+            return u'created'
         else:
             # Update package.
-            package['id'] = existing_package['id']
+            package['id'] = existing_package_infos['id']
             package['state'] = 'active'
 
             # Keep existing groups when they already exist.
             existing_groups = [
-                dict(id = existing_group['id'])
-                for existing_group in (existing_package.get('groups') or [])
+                dict(id = existing_group_id)
+                for existing_group_id in existing_package_infos['groups']
                 ]
             if existing_groups:
                 if package.get('groups'):
@@ -1343,29 +1969,38 @@ def upsert_package(name, package):
                 else:
                     package['groups'] = existing_groups
 
-            if name not in kept_packages_name:
-                request = urllib2.Request(urlparse.urljoin(conf['ckan.site_url'],
-                    'api/3/action/package_update?id={}'.format(name)), headers = ckan_headers)
-                try:
-                    response = urllib2.urlopen(request, urllib.quote(json.dumps(package)))
-                except urllib2.HTTPError as response:
-                    response_text = response.read()
-                    log.error(u'An exception occured while updating package: {0}'.format(package))
-                    try:
-                        response_dict = json.loads(response_text)
-                    except ValueError:
-                        log.error(response_text)
-                        raise
-                    for key, value in response_dict.iteritems():
-                        log.debug('{} = {}'.format(key, value))
-                    raise
-                else:
-                    assert response.code == 200
-                    response_dict = json.loads(response.read())
-                    assert response_dict['success'] is True
-#                    updated_package = response_dict['result']
-#                    pprint.pprint(updated_package)
-    return package
+            if name in kept_packages_name:
+                return u'kept'
+            if existing_package_infos['state'] == 'active' and existing_package_infos['hash'] == hash_package(package) \
+                    and set(group['id'] for group in (package.get('groups') or [])).issubset(
+                        existing_package_infos['groups']):
+                # Package has not changed since last import: Don't update it (nor reindex it).
+                return u'unchanged'
+            if staging_store is not None:
+                staging_store.stage(u'update', name, package)
+                return u'staged'
+            update_package(name, package)
+            return u'updated'
+    return None
+
+
+def write_checkpoint(package_name, package_id, package_hash):
+    """Append an upserted package to the checkpoint journal, synchronizing it on disk every few packages."""
+    global checkpoint_journal_writes_count
+    with checkpoint_journal_lock:
+        checkpoint_journal_file.write(json.dumps([package_name, package_id, package_hash]) + '\n')
+        checkpoint_journal_writes_count += 1
+        if checkpoint_journal_writes_count % args.checkpoint_interval == 0:
+            checkpoint_journal_file.flush()
+            os.fsync(checkpoint_journal_file.fileno())
+
+
+def write_staged_package(action, name, package):
+    """Create or update in CKAN a package that could not be written in the staging store."""
+    if action == u'create':
+        create_package(package)
+    else:
+        update_package(name, package)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+
+# Etalab-to-CKAN -- Tools to help migration of data.gouv.fr to CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-to-ckan
+#
+# This file is part of Etalab-to-CKAN.
+#
+# Etalab-to-CKAN is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-to-CKAN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Wall & CPU times of the phases of a script and statistics of its CKAN requests, reported in JSON or Prometheus."""
+
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+# Upper bounds (in seconds) of the buckets of the histograms of requests durations
+request_duration_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def get_cpu_time():
+    """Return the CPU time (user + system) used by the process, all threads included."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Metrics(object):
+    """Collector of the timings of phases and of CKAN requests.
+
+    Phases are sequential: starting a phase ends the current one. Timings (like the time spent waiting for Wenodata or
+    MongoDB) that happen inside phases are accumulated separately, using ``timing`` or ``iter_timed``, or
+    ``concurrent_timing`` for work done by several threads at once, during several phases.
+    """
+    def __init__(self):
+        self.active_timing_by_name = {}
+        self.counts = collections.OrderedDict()
+        self.current_phase = None
+        self.lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+        self.requests_by_action = {}
+        self.started_at = time.time()
+        self.timings = collections.OrderedDict()
+
+    def add_timing(self, name, wall_time, cpu_time):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = dict(count = 0, cpu_seconds = 0.0, wall_seconds = 0.0)
+            timing['count'] += 1
+            timing['cpu_seconds'] += cpu_time
+            timing['wall_seconds'] += wall_time
+
+    @contextlib.contextmanager
+    def concurrent_timing(self, name):
+        """Like ``timing``, for work done by several threads at once (thread-safe).
+
+        Wall & CPU times are accumulated only while at least one thread is doing the work, instead of summing the
+        durations of the threads.
+        """
+        with self.lock:
+            active_timing = self.active_timing_by_name.get(name)
+            if active_timing is None:
+                active_timing = self.active_timing_by_name[name] = dict(count = 0)
+            if active_timing['count'] == 0:
+                active_timing['cpu_started_at'] = get_cpu_time()
+                active_timing['started_at'] = time.time()
+            active_timing['count'] += 1
+        try:
+            yield
+        finally:
+            cpu_time = 0.0
+            wall_time = 0.0
+            with self.lock:
+                active_timing['count'] -= 1
+                if active_timing['count'] == 0:
+                    cpu_time = get_cpu_time() - active_timing['cpu_started_at']
+                    wall_time = time.time() - active_timing['started_at']
+            self.add_timing(name, wall_time, cpu_time)
+
+    def end_phase(self):
+        if self.current_phase is None:
+            return
+        name, started_at, cpu_started_at = self.current_phase
+        phase = self.phases.setdefault(name, dict(cpu_seconds = 0.0, wall_seconds = 0.0))
+        phase['cpu_seconds'] += get_cpu_time() - cpu_started_at
+        phase['wall_seconds'] += time.time() - started_at
+        self.current_phase = None
+
+    def iter_timed(self, name, iterable):
+        """Iterate over an iterable, accumulating the time spent waiting for its items in timing ``name``."""
+        iterator = iter(iterable)
+        while True:
+            with self.timing(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record_request(self, action, duration, error = False):
+        """Record the duration (in seconds) of a CKAN request (thread-safe)."""
+        with self.lock:
+            requests = self.requests_by_action.get(action)
+            if requests is None:
+                requests = self.requests_by_action[action] = dict(
+                    buckets_count = [0] * len(request_duration_buckets),
+                    count = 0,
+                    errors_count = 0,
+                    seconds = 0.0,
+                    )
+            for index, bucket in enumerate(request_duration_buckets):
+                if duration <= bucket:
+                    requests['buckets_count'][index] += 1
+            requests['count'] += 1
+            if error:
+                requests['errors_count'] += 1
+            requests['seconds'] += duration
+
+    def start_phase(self, name):
+        self.end_phase()
+        self.current_phase = (name, time.time(), get_cpu_time())
+
+    @contextlib.contextmanager
+    def timing(self, name):
+        started_at = time.time()
+        cpu_started_at = get_cpu_time()
+        try:
+            yield
+        finally:
+            self.add_timing(name, time.time() - started_at, get_cpu_time() - cpu_started_at)
+
+    def to_json(self):
+        """Return the report of the metrics, as a JSON-serializable dict."""
+        with self.lock:
+            return collections.OrderedDict([
+                ('wall_seconds', time.time() - self.started_at),
+                ('cpu_seconds', get_cpu_time()),
+                ('phases', self.phases),
+                ('timings', self.timings),
+                ('ckan_requests', collections.OrderedDict(
+                    (action, dict(
+                        buckets = collections.OrderedDict(
+                            (str(bucket), bucket_count)
+                            for bucket, bucket_count in zip(request_duration_buckets, requests['buckets_count'])
+                            ),
+                        count = requests['count'],
+                        errors_count = requests['errors_count'],
+                        seconds = requests['seconds'],
+                        ))
+                    for action, requests in sorted(self.requests_by_action.iteritems())
+                    )),
+                ('counts', self.counts),
+                ])
+
+    def to_prometheus(self, prefix):
+        """Return the metrics in the text exposition format of Prometheus, each name starting with prefix."""
+        lines = []
+        with self.lock:
+            for metric_name, value_name, values_by_name in (
+                    ('phase_cpu_seconds', 'cpu_seconds', self.phases),
+                    ('phase_wall_seconds', 'wall_seconds', self.phases),
+                    ('timing_cpu_seconds', 'cpu_seconds', self.timings),
+                    ('timing_wall_seconds', 'wall_seconds', self.timings),
+                    ):
+                lines.append('# TYPE {}_{} gauge'.format(prefix, metric_name))
+                for name, values in values_by_name.iteritems():
+                    lines.append('{}_{}{{name="{}"}} {!r}'.format(prefix, metric_name, name, values[value_name]))
+            lines.append('# TYPE {}_ckan_request_duration_seconds histogram'.format(prefix))
+            for action, requests in sorted(self.requests_by_action.iteritems()):
+                for bucket, bucket_count in zip(request_duration_buckets, requests['buckets_count']):
+                    lines.append('{}_ckan_request_duration_seconds_bucket{{action="{}",le="{!r}"}} {}'.format(prefix,
+                        action, bucket, bucket_count))
+                lines.append('{}_ckan_request_duration_seconds_bucket{{action="{}",le="+Inf"}} {}'.format(prefix,
+                    action, requests['count']))
+                lines.append('{}_ckan_request_duration_seconds_sum{{action="{}"}} {!r}'.format(prefix, action,
+                    requests['seconds']))
+                lines.append('{}_ckan_request_duration_seconds_count{{action="{}"}} {}'.format(prefix, action,
+                    requests['count']))
+            lines.append('# TYPE {}_ckan_request_errors_total counter'.format(prefix))
+            for action, requests in sorted(self.requests_by_action.iteritems()):
+                lines.append('{}_ckan_request_errors_total{{action="{}"}} {}'.format(prefix, action,
+                    requests['errors_count']))
+            for count_name, count_by_label in self.counts.iteritems():
+                lines.append('# TYPE {}_{} gauge'.format(prefix, count_name))
+                for label, count in sorted(count_by_label.iteritems()):
+                    lines.append('{}_{}{{name="{}"}} {}'.format(prefix, count_name, label, count))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, file_path):
+        self.end_phase()
+        with open(file_path, 'w') as report_file:
+            json.dump(self.to_json(), report_file, indent = 2)
+
+    def write_prometheus(self, file_path, prefix):
+        self.end_phase()
+        # Write atomically, for the textfile collector of Prometheus node exporter may read the file at any time.
+        with open(file_path + '.tmp', 'w') as metrics_file:
+            metrics_file.write(self.to_prometheus(prefix))
+        os.rename(file_path + '.tmp', file_path)
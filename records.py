@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+
+# Etalab-to-CKAN -- Tools to help migration of data.gouv.fr to CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-to-ckan
+#
+# This file is part of Etalab-to-CKAN.
+#
+# Etalab-to-CKAN is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-to-CKAN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Compact records of the packages generated from data.gouv.fr entries and of their resources.
+
+Records use slots instead of a dict and share the strings that are repeated in many packages (organizations, formats,
+licenses, dates, tags...). They behave like the dicts of packages and resources of the CKAN API, an unset slot being a
+missing key, and are converted to real dicts only when they are sent to CKAN.
+"""
+
+
+string_by_value = {}
+
+
+def intern_string(value):
+    """Return the first equal string seen, so that equal strings share the same object (works with unicode)."""
+    if isinstance(value, basestring):
+        return string_by_value.setdefault(value, value)
+    if isinstance(value, tuple):
+        return tuple(
+            intern_string(item)
+            for item in value
+            )
+    return value
+
+
+class Record(object):
+    __slots__ = ()
+    interned_keys = frozenset()
+
+    def __init__(self, **values):
+        for key, value in values.iteritems():
+            self[key] = value
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __getstate__(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{} = {!r}'.format(key, value)
+            for key, value in self.iteritems()
+            ))
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, intern_string(value) if key in self.interned_keys else value)
+
+    def __setstate__(self, state):
+        # Strings are interned again, because unpickling (in another process) creates new ones.
+        for key, value in state.iteritems():
+            self[key] = value
+
+    def copy(self):
+        """Return a shallow copy of the record, like dict.copy."""
+        return self.__class__(**dict(self.iteritems()))
+
+    def get(self, key, default = None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def iteritems(self):
+        for key in self.__slots__:
+            value = getattr(self, key, self)
+            if value is not self:
+                yield key, value
+
+
+class Package(Record):
+    """Package generated from a data.gouv.fr entry.
+
+    Extras are indexed by key (in an OrderedDict), resources are Resource records and tags are a tuple of names.
+    """
+    __slots__ = (
+        'author',
+        'extras',
+        'frequency',
+        'groups',
+        'id',
+        'license_id',
+        'maintainer',
+        'name',
+        'notes',
+        'owner_org',
+        'resources',
+        'state',
+        'tags',
+        'temporal_coverage_from',
+        'temporal_coverage_to',
+        'title',
+        )
+    interned_keys = frozenset([
+        'author',
+        'frequency',
+        'license_id',
+        'maintainer',
+        'owner_org',
+        'tags',
+        'temporal_coverage_from',
+        'temporal_coverage_to',
+        ])
+
+    def to_ckan(self):
+        """Return the package as a dict, in the format of the CKAN API."""
+        package = dict(self.iteritems())
+        if 'extras' in package:
+            package['extras'] = [
+                dict(
+                    # deleted = True,
+                    key = key,
+                    value = value,
+                    )
+                for key, value in package['extras'].iteritems()
+                ]
+        if 'resources' in package:
+            package['resources'] = [
+                dict(resource.iteritems())
+                for resource in package['resources']
+                ]
+        if 'tags' in package:
+            package['tags'] = [
+                dict(
+                    name = tag_name,
+#                    vocabulary_id (string) – the name or id of the vocabulary that the new tag should be added to, e.g. 'Genre'
+                    )
+                for tag_name in package['tags']
+                ]
+        return package
+
+
+class Resource(Record):
+    __slots__ = (
+        'created',
+        'description',
+        'format',
+        'last_modified',
+        'name',
+        'url',
+        )
+    interned_keys = frozenset([
+        'created',
+        'format',
+        'last_modified',
+        ])
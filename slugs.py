@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+
+# Etalab-to-CKAN -- Tools to help migration of data.gouv.fr to CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-to-ckan
+#
+# This file is part of Etalab-to-CKAN.
+#
+# Etalab-to-CKAN is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-to-CKAN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Memoized slugify, for the texts (sources, organizations, keywords...) that are slugified again and again.
+
+Every process has its own memo (and its own counts).
+"""
+
+
+import collections
+
+from biryani1 import strings
+
+
+memo_max_size = 100000  # When this number of slugs is reached, the memo is emptied, to bound memory usage.
+slug_by_text = {}
+slugify_calls_count = collections.Counter()
+
+
+def slugify(text, memoize = True):
+    """Return the slug of a text, like ``biryani1.strings.slugify``.
+
+    Long texts that are slugified only once (like descriptions) should not be memoized, to spare the memo.
+    """
+    if not memoize:
+        return strings.slugify(text)
+    slug = slug_by_text.get(text)
+    if slug is None:
+        slugify_calls_count['miss'] += 1
+        if len(slug_by_text) >= memo_max_size:
+            slug_by_text.clear()
+        slug = slug_by_text[text] = strings.slugify(text)
+    else:
+        slugify_calls_count['hit'] += 1
+    return slug
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+
+# Etalab-to-CKAN -- Tools to help migration of data.gouv.fr to CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-to-ckan
+#
+# This file is part of Etalab-to-CKAN.
+#
+# Etalab-to-CKAN is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-to-CKAN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Local staging store of the packages to create or update in CKAN, written in batches instead of one request each.
+
+Packages are kept in a SQLite table, as the JSON dicts expected by package_create & package_update, so that a bulk
+loader can then load them into CKAN.
+"""
+
+
+import json
+import logging
+import sqlite3
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class StagingStore(object):
+    """Buffer staged packages and write them to SQLite, one transaction per batch.
+
+    Batches are detached from the pending packages and written separately, so that writing a batch (possibly by several
+    threads at once) doesn't block the threads staging packages.
+
+    When a batch can't be written, each of its packages is given to the fallback function (if any), called with the
+    action (u'create' or u'update'), the name and the package.
+    """
+    def __init__(self, path, fallback = None):
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        self.connection.execute("""\
+            CREATE TABLE IF NOT EXISTS packages (
+                name TEXT PRIMARY KEY,
+                action TEXT NOT NULL,
+                package TEXT NOT NULL
+            )
+            """)
+        self.connection.commit()
+        self.connection_lock = threading.Lock()
+        self.fallback = fallback
+        self.lock = threading.Lock()
+        self.pending = []
+        self.staged_count = 0
+
+    def close(self):
+        self.connection.close()
+
+    def detach(self):
+        """Remove the pending packages and return them, as a batch to write."""
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        return pending
+
+    def stage(self, action, name, package):
+        """Add a package to create or update to the pending packages."""
+        with self.lock:
+            self.pending.append((action, name, package))
+
+    def write(self, packages):
+        """Write a batch of (action, name, package) triples in the store.
+
+        Return the (action, name, package, error) quadruples of the packages given to the fallback, error being None
+        when the fallback succeeded, or of every package when the store failed and there is no fallback.
+        """
+        if not packages:
+            return []
+        try:
+            with self.connection_lock, self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO packages VALUES (?, ?, ?)', [
+                    (name, action, json.dumps(package))
+                    for action, name, package in packages
+                    ])
+                self.staged_count += len(packages)
+        except sqlite3.Error as error:
+            if self.fallback is None:
+                log.exception(u'Staging of {} packages failed'.format(len(packages)))
+                return [
+                    (action, name, package, error)
+                    for action, name, package in packages
+                    ]
+            log.exception(u'Staging of {} packages failed: Writing them one by one'.format(len(packages)))
+        else:
+            return []
+        written = []
+        for action, name, package in packages:
+            try:
+                self.fallback(action, name, package)
+            except Exception as error:
+                log.exception(u'An exception occured while writing package {}'.format(name))
+            else:
+                error = None
+            written.append((action, name, package, error))
+        return written